@@ -0,0 +1,277 @@
+import os
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+
+import io
+import json
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from scipy.io.wavfile import write as write_wav
+
+from parse_test import parse_args, MONO_MODES
+from models import Models_functions
+from utils import Utils_functions
+from constants import GENRES, MAX_SECONDS
+from scheduler import SchedulerFull
+from reload import watch_checkpoints
+
+
+FORMATS = {"wav": "audio/wav", "pcm16": "application/octet-stream", "npy": "application/octet-stream"}
+
+
+class JobServer:
+    # generation jobs run on a worker pool and pass through the same scheduler as the interface
+    def __init__(self, args, U, models_ls, max_results=256):
+        self.args = args
+        self.U = U
+        self.models_ls = models_ls
+        self.max_results = max_results
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+        self.executor = ThreadPoolExecutor(max_workers=args.max_concurrent + args.max_queued)
+
+    def parse_job(self, body):
+        if not isinstance(body, dict):
+            raise ValueError("request body must be a JSON object")
+        genre = body.get("genre", 2)
+        if isinstance(genre, str):
+            if genre not in GENRES:
+                raise ValueError(f"genre must be one of {GENRES}")
+            genre = GENRES.index(genre)
+        genre = int(genre)
+        if genre not in range(len(GENRES)):
+            raise ValueError(f"genre index must be between 0 and {len(GENRES) - 1}")
+        duration = float(body.get("duration", 23.0))
+        if not 0.0 < duration <= MAX_SECONDS:
+            raise ValueError(f"duration must be between 0 and {MAX_SECONDS} seconds")
+        truncation = float(body.get("truncation", 1.8))
+        if not 0.0 < truncation <= 4.0:
+            raise ValueError("truncation must be between 0 and 4")
+        seed = body.get("seed")
+        fmt = body.get("format", "wav")
+        if fmt not in FORMATS:
+            raise ValueError(f"format must be one of {list(FORMATS)}")
+        mono = body.get("mono", self.args.mono)
+        if mono not in MONO_MODES:
+            raise ValueError(f"mono must be one of {MONO_MODES}")
+        if sum(bool(body.get(key, False)) for key in ("loop", "compare", "best_of")) > 1:
+            raise ValueError("loop, compare and best_of cannot be combined")
+        best_of = int(body.get("best_of", 0))
+        top_k = int(body.get("top_k", 1))
+        if best_of and (self.args.best_of <= 1 or not 1 <= top_k <= best_of <= 64):
+            raise ValueError("best_of needs critics loaded with --best_of and 1 <= top_k <= best_of <= 64")
+        return {
+            "genre": genre,
+            "duration": duration,
+            "truncation": truncation,
+            "seed": None if seed is None else int(seed),
+            "format": fmt,
+            "loop": bool(body.get("loop", False)),
+            "mono": mono,
+            "compare": bool(body.get("compare", False)),
+            "best_of": best_of,
+            "top_k": top_k,
+        }
+
+    def submit(self, spec):
+        job = {"id": uuid.uuid4().hex, "spec": spec, "status": "queued", "submitted": time.time()}
+        with self.lock:
+            self.jobs[job["id"]] = job
+        self.evict()
+        self.executor.submit(self.run, job)
+        return job
+
+    def evict(self):
+        # forget finished jobs, oldest first, past max_results, the result size budget or the time to live
+        now = time.time()
+        with self.lock:
+            finished = [j for j in self.jobs.values() if "finished" in j]
+            finished.sort(key=lambda j: j["finished"])
+            nbytes = sum(len(r) for j in finished for r in j.get("results", []))
+            for i, j in enumerate(finished):
+                if (
+                    len(finished) - i <= self.max_results
+                    and nbytes <= self.args.api_result_mb * 2**20
+                    and now - j["finished"] <= self.args.api_result_ttl
+                ):
+                    break
+                nbytes -= sum(len(r) for r in j.get("results", []))
+                del self.jobs[j["id"]]
+
+    # list of waveforms: one per genre for compare jobs, top_k for best_of jobs, a single one otherwise
+    def render(self, spec):
+        critic, gen, enc, dec, enc2, dec2, gen_ema, [opt_dec, opt_disc], switch = self.models_ls[spec["genre"]]
+        fac, samples = self.U.duration_plan(spec["duration"])
+        # wav and pcm16 are assembled directly as int16
+        dtype = np.float32 if spec["format"] == "npy" else np.int16
+        if spec["best_of"]:
+            return self.U.generate_best_of(
+                fac,
+                spec["truncation"],
+                gen_ema,
+                critic,
+                dec,
+                dec2,
+                n=spec["best_of"],
+                k=spec["top_k"],
+                batch_size=64,
+                dtype=dtype,
+                mono=spec["mono"],
+                samples=samples,
+                seed=spec["seed"],
+            )
+        if spec["compare"]:
+            # the decoders are the same for every checkpoint
+            gen_emas = [models_ls[6] for models_ls in self.models_ls]
+            noiseinp = self.U.get_noise_interp_multi(fac, spec["truncation"], seed=spec["seed"])
+            return self.U.generate_comparison(
+                noiseinp, gen_emas, dec, dec2, batch_size=64, dtype=dtype, mono=spec["mono"], samples=samples
+            )
+        if spec["loop"]:
+            wv = self.U.generate_loop(
+                fac,
+                spec["truncation"],
+                gen_ema,
+                dec,
+                dec2,
+                batch_size=64,
+                seed=spec["seed"],
+                dtype=dtype,
+                mono=spec["mono"],
+                samples=samples,
+            )
+            return [wv]
+        noiseinp = self.U.get_noise_interp_multi(fac, spec["truncation"], seed=spec["seed"])
+        return [
+            self.U.generate_waveform(
+                noiseinp, gen_ema, dec, dec2, batch_size=64, dtype=dtype, mono=spec["mono"], samples=samples
+            )
+        ]
+
+    def encode(self, wv, fmt):
+        buf = io.BytesIO()
+        if fmt == "wav":
+            write_wav(buf, self.args.sr, wv)
+        elif fmt == "pcm16":
+            buf.write(wv.tobytes())
+        else:
+            np.save(buf, wv)
+        return buf.getvalue()
+
+    def run(self, job):
+        spec = job["spec"]
+        try:
+            if spec["loop"]:
+                genre, cost = spec["genre"], 1
+            elif spec["compare"]:
+                genre, cost = "compare", self.U.duration_windows(spec["duration"])
+            elif spec["best_of"]:
+                genre, cost = spec["genre"], self.U.duration_windows(spec["duration"]) * spec["top_k"]
+            else:
+                genre, cost = spec["genre"], self.U.duration_windows(spec["duration"])
+            with self.U.scheduler.slot(genre, cost):
+                job["status"] = "running"
+                job["queue_wait"] = time.time() - job["submitted"]
+                bef = time.time()
+                job["results"] = [self.encode(wv, spec["format"]) for wv in self.render(spec)]
+                job["run_time"] = time.time() - bef
+                job["status"] = "done"
+        except SchedulerFull as e:
+            job["status"] = "rejected"
+            job["error"] = str(e)
+        except Exception as e:
+            job["status"] = "failed"
+            job["error"] = repr(e)
+            self.U.metrics.count("failed")
+        job["finished"] = time.time()
+        self.evict()
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def status(self, job):
+        keys = ["id", "status", "queue_wait", "run_time", "error"]
+        return {k: job[k] for k in keys if k in job}
+
+
+class Handler(BaseHTTPRequestHandler):
+    def send_json(self, code, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server.job_server
+        if self.path.rstrip("/") != "/jobs":
+            return self.send_json(404, {"error": "not found"})
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            spec = server.parse_job(json.loads(self.rfile.read(length) or b"{}"))
+        except (ValueError, TypeError) as e:
+            return self.send_json(400, {"error": str(e)})
+        if server.U.scheduler.saturated():
+            server.U.metrics.count("rejected")
+            return self.send_json(503, {"error": "Server is busy, please try again in a moment."})
+        job = server.submit(spec)
+        self.send_json(202, server.status(job))
+
+    def do_GET(self):
+        server = self.server.job_server
+        parts = [p for p in self.path.split("/") if p]
+        if parts == ["metrics"]:
+            return self.send_json(200, server.U.metrics.summary())
+        if len(parts) not in (2, 3, 4) or parts[0] != "jobs" or (len(parts) > 2 and parts[2] != "result"):
+            return self.send_json(404, {"error": "not found"})
+        job = server.get(parts[1])
+        if job is None:
+            return self.send_json(404, {"error": "unknown job"})
+        if len(parts) == 2:
+            return self.send_json(200, server.status(job))
+        if job["status"] != "done":
+            return self.send_json(409, server.status(job))
+        # compare jobs have one result per genre: /jobs/<id>/result/<genre index>
+        k = parts[3] if len(parts) == 4 else "0"
+        if not k.isdigit() or int(k) >= len(job["results"]):
+            return self.send_json(404, {"error": "unknown result"})
+        result = job["results"][int(k)]
+        self.send_response(200)
+        self.send_header("Content-Type", FORMATS[job["spec"]["format"]])
+        self.send_header("Content-Length", str(len(result)))
+        self.end_headers()
+        self.wfile.write(result)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(args, U, models_ls):
+    httpd = ThreadingHTTPServer((args.api_host, args.api_port), Handler)
+    httpd.job_server = JobServer(args, U, models_ls)
+    print(f"Job API listening on http://{args.api_host}:{args.api_port}")
+    httpd.serve_forever()
+
+
+if __name__ == "__main__":
+
+    # parse args
+    args = parse_args()
+
+    # initialize networks
+    M = Models_functions(args)
+    models_ls_1, models_ls_2, models_ls_3 = M.get_networks()
+
+    # serve generation jobs without the interface
+    U = Utils_functions(args)
+    models_ls = [models_ls_1, models_ls_2, models_ls_3]
+    watch_checkpoints(M, models_ls, U.metrics)
+    serve(args, U, models_ls)
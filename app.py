@@ -1,6 +1,7 @@
 from parse_test import parse_args
 from models import Models_functions
 from utils import Utils_functions
+from reload import watch_checkpoints
 
 
 # parse args
@@ -12,4 +13,6 @@ models_ls_1, models_ls_2, models_ls_3 = M.get_networks()
 
 # test musika
 U = Utils_functions(args)
-U.render_gradio(models_ls_1, models_ls_2, models_ls_3, train=False)
+models_ls = [models_ls_1, models_ls_2, models_ls_3]
+watch_checkpoints(M, models_ls, U.metrics)
+U.render_gradio(models_ls, train=False)
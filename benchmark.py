@@ -0,0 +1,292 @@
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+
+# parse_test sets the XLA flags before TensorFlow is imported
+from parse_test import parse_args, EasyDict
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.framework import ops
+
+from models import Models_functions, JitModel
+from utils import Utils_functions
+
+
+BENCH_FACS = [1, 5, 10]
+BENCH_REPEATS = 3
+BENCH_SEED = 42
+BENCH_TRUNCATION = 1.8
+
+# optimized modes, as overrides of the float32 reference settings
+MODES = {
+    "current": {},
+    "mixed": {"mixed_precision": True},
+    "bf16": {"precision": "bf16"},
+    "jit": {"jit": True},
+    "prune": {"noise_threshold": 0.01},
+    "bank": {"noise_bank": 8},
+    "batch16": {"batch_size": 16},
+    # distance of the mono render to the downmix of the stereo reference
+    "mono_mid": {"mono": "mid"},
+    "mono_left": {"mono": "left"},
+}
+
+
+def reference_args(args):
+    # plain float32 path used as quality and speed reference
+    ref_args = EasyDict(args)
+    ref_args.mixed_precision = False
+    ref_args.precision = "fp32"
+    ref_args.datatype = tf.float32
+    ref_args.jit = False
+    ref_args.noise_threshold = 0.0
+    ref_args.noise_bank = 0
+    ref_args.mono = "none"
+    return ref_args
+
+
+def mode_args(args, name):
+    # settings of an optimized mode, None if it is not available on this device
+    if name == "current":
+        mod_args = EasyDict(args)
+    else:
+        mod_args = reference_args(args)
+        mod_args.update({k: v for k, v in MODES[name].items() if k != "batch_size"})
+    mod_args.batch_size = MODES[name].get("batch_size", 64)
+    if mod_args.mixed_precision:
+        if args.cpu:
+            return None
+        mod_args.datatype = tf.float16
+    elif mod_args.precision == "bf16":
+        if not args.cpu:
+            return None
+        mod_args.datatype = tf.bfloat16
+    return mod_args
+
+
+def load_models(args, path=None):
+    M = Models_functions(args)
+    critic, gen, enc, dec, enc2, dec2, gen_ema, [opt_dec, opt_disc], switch = M.load(
+        args.load_path_3 if path is None else path, load_dec=False
+    )
+    if args.jit:
+        dec, dec2, gen_ema = JitModel(dec), JitModel(dec2), JitModel(gen_ema)
+    return critic, gen, enc, dec, enc2, dec2, gen_ema, [opt_dec, opt_disc], switch
+
+
+def time_models(args, models_ls, bs=16, repeats=BENCH_REPEATS):
+    critic, gen, enc, dec, enc2, dec2, gen_ema, [opt_dec, opt_disc], switch = models_ls
+    inputs = {
+        "GEN": (gen_ema, tf.random.normal([bs, args.latlen, args.latdepth * 2])),
+        "DEC2": (dec2, tf.random.normal([bs, 1, args.shape // 32, args.latdepth])),
+        "DEC": (dec, tf.random.normal([bs, 1, args.shape // 2, args.hop // 4])),
+    }
+    latencies = {}
+    for name, (model, inp) in inputs.items():
+        model(inp, training=False)
+        times = []
+        for _ in range(repeats):
+            bef = time.time()
+            out = model(inp, training=False)
+            np.asarray(out[0] if isinstance(out, (list, tuple)) else out)
+            times.append(time.time() - bef)
+        latencies[name] = float(np.median(times))
+    return latencies
+
+
+def time_render(U, noiseinp, models_ls, seed, repeats=BENCH_REPEATS, batch_size=64):
+    critic, gen, enc, dec, enc2, dec2, gen_ema, [opt_dec, opt_disc], switch = models_ls
+    U.generate_waveform(noiseinp, gen_ema, dec, dec2, batch_size=batch_size, mono=U.args.mono)
+    times = []
+    for _ in range(repeats):
+        tf.random.set_seed(seed)
+        bef = time.time()
+        wv = U.generate_waveform(noiseinp, gen_ema, dec, dec2, batch_size=batch_size, mono=U.args.mono)
+        times.append(time.time() - bef)
+    return wv, float(np.median(times))
+
+
+def time_assembly(U, fac, repeats=BENCH_REPEATS):
+    # output assembly alone, on iSTFT-sized channels: previous stack/clip/int16 copies vs the int16 buffer
+    frames = fac * (U.args.latlen // 8) * U.args.shape
+    chls = [np.random.uniform(-1.2, 1.2, (frames + 3) * U.args.hop).astype(np.float32) for _ in range(2)]
+
+    def stacked():
+        wv = np.clip(np.squeeze(np.stack(chls, -1)), -1.0, 1.0)
+        return np.int16(wv * 32767.0)
+
+    def buffered():
+        out = U.output_buffer(frames, np.int16)
+        for channel, wv in enumerate(chls):
+            U.write_channel(out, channel, wv)
+        return out
+
+    results = {}
+    for name, fn in [("stack", stacked), ("buffer", buffered)]:
+        tracemalloc.start()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        times = []
+        for _ in range(repeats):
+            bef = time.time()
+            fn()
+            times.append(time.time() - bef)
+        results[name] = (float(np.median(times)), peak)
+    return results
+
+
+@contextmanager
+def count_transfers():
+    # counts device-to-host copies: tensor.numpy() and np.asarray(tensor) both go through _numpy
+    counts = {"copies": 0, "bytes": 0}
+    orig = ops._EagerTensorBase._numpy
+
+    def counted(self):
+        arr = orig(self)
+        counts["copies"] += 1
+        counts["bytes"] += arr.nbytes
+        return arr
+
+    ops._EagerTensorBase._numpy = counted
+    try:
+        yield counts
+    finally:
+        ops._EagerTensorBase._numpy = orig
+
+
+def host_distribute_dec(x, model, bs=32):
+    # distribute_dec before decoder outputs stayed in TF: batches are concatenated on the host
+    outls = []
+    for i in range(-(-x.shape[0] // bs)):
+        inp = tf.concat(tf.split(x[i * bs : i * bs + bs], 2, -2), 0)
+        outls.append(model(inp, training=False))
+    return np.concatenate([out[0] for out in outls], 0), np.concatenate([out[1] for out in outls], 0)
+
+
+def transfer_report(U, models_ls, fac, batch_size=64):
+    # copies to NumPy made by one render through generate_waveform, with the previous host
+    # concatenation of the DEC outputs ("before") and the current path ("after")
+    critic, gen, enc, dec, enc2, dec2, gen_ema, [opt_dec, opt_disc], switch = models_ls
+    noiseinp = U.get_noise_interp_multi(fac, BENCH_TRUNCATION, seed=BENCH_SEED)
+    U.generate_waveform(noiseinp, gen_ema, dec, dec2, batch_size=batch_size, mono=U.args.mono)
+    results = {}
+    for name in ["before", "after"]:
+        if name == "before":
+            U.distribute_dec = host_distribute_dec
+        try:
+            with count_transfers() as counts:
+                U.generate_waveform(noiseinp, gen_ema, dec, dec2, batch_size=batch_size, mono=U.args.mono)
+        finally:
+            # drop the instance override, back to Utils_functions.distribute_dec
+            U.__dict__.pop("distribute_dec", None)
+        results[name] = counts
+    return results
+
+
+def render_pieces(U, models_ls, seeds, batch_size=64, repeats=BENCH_REPEATS):
+    # fixed set of seeded pieces: same coordinates and decoder noise seed for every mode
+    pieces = {}
+    for fac in BENCH_FACS:
+        for seed in seeds:
+            noiseinp = U.get_noise_interp_multi(fac, BENCH_TRUNCATION, seed=seed)
+            pieces[fac, seed] = time_render(U, noiseinp, models_ls, seed, repeats, batch_size)
+    return pieces
+
+
+def noise_floor(U, models_ls, pieces, seeds):
+    # same coordinates, different decoder noise: distance expected from noise injection alone
+    floors = {}
+    for fac in BENCH_FACS:
+        dists = []
+        for seed in seeds:
+            noiseinp = U.get_noise_interp_multi(fac, BENCH_TRUNCATION, seed=seed)
+            wv, _ = time_render(U, noiseinp, models_ls, seed + 1, repeats=1)
+            dists.append(U.spectral_distance(pieces[fac, seed][0], wv))
+        floors[fac] = np.mean(dists)
+    return floors
+
+
+def regression(args):
+    seeds = [BENCH_SEED + i for i in range(args.bench_seeds)]
+    modes = ["current"] + [m for m in args.bench_modes.split(",") if m and m != "current"]
+    for m in modes:
+        if m not in MODES:
+            raise ValueError(f"Unknown benchmark mode {m}, available: {list(MODES)}")
+    paths = [args.load_path_1, args.load_path_2, args.load_path_3]
+
+    rows = []
+    for path in paths:
+        ref_args = reference_args(args)
+        models_ref = load_models(ref_args, path)
+        U_ref = Utils_functions(ref_args)
+        lat_ref = time_models(ref_args, models_ref)
+        pieces_ref = render_pieces(U_ref, models_ref, seeds)
+        floors = noise_floor(U_ref, models_ref, pieces_ref, seeds)
+        del models_ref
+
+        for m in modes:
+            mod_args = mode_args(args, m)
+            if mod_args is None:
+                print(f"Skipping mode {m}: not available on this device")
+                continue
+            models_mod = load_models(mod_args, path)
+            U = Utils_functions(mod_args)
+            lat_mod = time_models(mod_args, models_mod)
+            print(
+                f"{os.path.basename(os.path.normpath(path))} {m}: "
+                + " ".join(f"{name} {lat_ref[name] / lat_mod[name]:.2f}x" for name in lat_ref)
+            )
+            pieces = render_pieces(U, models_mod, seeds, mod_args.batch_size)
+            for fac in BENCH_FACS:
+                t_ref = np.mean([pieces_ref[fac, seed][1] for seed in seeds])
+                t_mod = np.mean([pieces[fac, seed][1] for seed in seeds])
+                dist = np.mean([U_ref.spectral_distance(pieces_ref[fac, seed][0], pieces[fac, seed][0]) for seed in seeds])
+                rows.append((os.path.basename(os.path.normpath(path)), m, fac, t_ref, t_mod, dist, floors[fac]))
+            del models_mod
+
+    print()
+    print(
+        f"{'checkpoint':>20} {'mode':>8} {'length':>7} {'ref (s)':>8} {'mode (s)':>8} {'speedup':>8} "
+        f"{'dist':>7} {'floor':>7} {'ratio':>6} {'':>4}"
+    )
+    failed = 0
+    for name, m, fac, t_ref, t_mod, dist, floor in rows:
+        # drift is measured relative to the distance caused by decoder noise alone
+        ratio = dist / max(floor, 1e-8)
+        ok = ratio <= args.bench_threshold
+        failed += not ok
+        print(
+            f"{name[-20:]:>20} {m:>8} {fac * 23:>6}s {t_ref:>8.3f} {t_mod:>8.3f} {t_ref / t_mod:>7.2f}x "
+            f"{dist:>7.4f} {floor:>7.4f} {ratio:>6.2f} {'ok' if ok else 'FAIL':>4}"
+        )
+    print()
+
+    U = Utils_functions(args)
+    print(f"{'assembly':>8} {'time (ms)':>10} {'peak (MB)':>10}")
+    for name, (t, peak) in time_assembly(U, BENCH_FACS[-1]).items():
+        print(f"{name:>8} {t * 1000:>10.2f} {peak / 2**20:>10.1f}")
+    print()
+
+    print(f"{'transfer':>8} {'copies':>7} {'moved (MB)':>11}")
+    for name, counts in transfer_report(U, load_models(args), BENCH_FACS[-1]).items():
+        print(f"{name:>8} {counts['copies']:>7} {counts['bytes'] / 2**20:>11.1f}")
+
+    if failed:
+        print(f"{failed} of {len(rows)} rows drifted past {args.bench_threshold}x the noise floor")
+    return failed
+
+
+if __name__ == "__main__":
+
+    # parse args
+    args = parse_args()
+
+    # render seeded pieces of every checkpoint with the float32 reference and each mode
+    # (e.g. --bench_modes jit,prune,bf16), exit code 1 if the quality of any mode drifted
+    sys.exit(1 if regression(args) else 0)
@@ -0,0 +1,123 @@
+import os
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+MANIFEST = "manifest.json"
+ALIGN = 64
+
+
+def is_sharded(path):
+    return os.path.exists(os.path.join(path, MANIFEST))
+
+
+def save_sharded(path, groups, shard_size=256 * 2**20, workers=8):
+    # groups maps a name to a list of arrays (e.g. model.get_weights()); tensors are packed into
+    # aligned shard files described by a manifest, which is written last
+    bef = time.time()
+    os.makedirs(path, exist_ok=True)
+    entries = []
+    shards = [[]]
+    size = 0
+    for group, arrays in groups.items():
+        for i, arr in enumerate(arrays):
+            arr = np.ascontiguousarray(arr)
+            if shards[-1] and size + arr.nbytes > shard_size:
+                shards.append([])
+                size = 0
+            entries.append(
+                {
+                    "group": group,
+                    "index": i,
+                    "shard": len(shards) - 1,
+                    "offset": size,
+                    "shape": list(arr.shape),
+                    "dtype": arr.dtype.str,
+                }
+            )
+            shards[-1].append(arr)
+            size += -(-arr.nbytes // ALIGN) * ALIGN
+
+    def write(k):
+        with open(os.path.join(path, f"shard-{k:05d}.bin"), "wb") as f:
+            for arr in shards[k]:
+                f.write(arr.tobytes())
+                f.write(b"\0" * (-arr.nbytes % ALIGN))
+
+    with ThreadPoolExecutor(workers) as ex:
+        list(ex.map(write, range(len(shards))))
+
+    manifest = {"version": 1, "shards": len(shards), "tensors": entries}
+    with open(os.path.join(path, MANIFEST + ".tmp"), "w") as f:
+        json.dump(manifest, f)
+    os.replace(os.path.join(path, MANIFEST + ".tmp"), os.path.join(path, MANIFEST))
+
+    nbytes = sum(arr.nbytes for shard in shards for arr in shard)
+    print(f"Checkpoint saved to {path} in {time.time() - bef:.2f} s ({nbytes / 2**20:.1f} MB)")
+
+
+def load_sharded(path, groups=None):
+    # returns name -> list of read-only arrays memory-mapped from the shard files
+    with open(os.path.join(path, MANIFEST)) as f:
+        manifest = json.load(f)
+    maps = {}
+    out = {}
+    for entry in manifest["tensors"]:
+        if groups is not None and entry["group"] not in groups:
+            continue
+        shard = entry["shard"]
+        if shard not in maps:
+            maps[shard] = np.memmap(os.path.join(path, f"shard-{shard:05d}.bin"), dtype=np.uint8, mode="r")
+        dtype = np.dtype(entry["dtype"])
+        nbytes = int(np.prod(entry["shape"], dtype=np.int64)) * dtype.itemsize
+        arr = maps[shard][entry["offset"] : entry["offset"] + nbytes].view(dtype).reshape(entry["shape"])
+        ls = out.setdefault(entry["group"], [])
+        ls.extend([None] * (entry["index"] + 1 - len(ls)))
+        ls[entry["index"]] = arr
+    return out
+
+
+def assign_parallel(pairs, workers=8):
+    # reading the mapped pages happens inside assign, so shards are read in parallel
+    with ThreadPoolExecutor(workers) as ex:
+        list(ex.map(lambda pair: pair[0].assign(pair[1]), pairs))
+
+
+def convert(M, src, dst):
+    # rewrite an h5/npy checkpoint directory in the sharded format
+    critic, gen, enc, dec, enc2, dec2, gen_ema, [opt_dec, opt_disc], switch = M.load(src, load_dec=False)
+    save_sharded(
+        dst,
+        {
+            "critic": critic.get_weights(),
+            "gen": gen.get_weights(),
+            "gen_ema": gen_ema.get_weights(),
+            "opt_dec": opt_dec.get_weights(),
+            "opt_disc": opt_disc.get_weights(),
+            "switch": [switch.numpy()],
+        },
+    )
+
+
+if __name__ == "__main__":
+
+    from parse_test import parse_args
+    from models import Models_functions
+
+    # parse args
+    args = parse_args()
+    # optimizer states and critic are needed for a complete checkpoint
+    args.testing = False
+
+    M = Models_functions(args)
+    convert(M, args.ckpt_src, args.ckpt_dst)
+
+    bef = time.time()
+    M.load(args.ckpt_dst, load_dec=False)
+    print(f"Sharded checkpoint loaded in {time.time() - bef:.2f} s")
@@ -0,0 +1,3 @@
+# shared by the serving code and tools that must not import TensorFlow (e.g. loadtest.py)
+GENRES = ["ComMU pretrained", "Only Mozart", "Mozart finetuned"]
+MAX_SECONDS = 600
@@ -0,0 +1,95 @@
+import numpy as np
+import tensorflow as tf
+
+
+class Piece:
+    # a generated piece together with what is needed to regenerate parts of it
+    def __init__(self, anchors, var, fac, coords, lat, specs, wv):
+        self.anchors = anchors  # coordinate anchors, each [1, 64 + coorddepth]
+        self.var = var
+        self.fac = fac
+        self.coords = coords  # [fac, latlen, 64 + coorddepth] generator inputs
+        self.lat = lat  # [fac, 1, latlen, latdepth * 2] generator outputs
+        self.specs = specs  # complex spectrogram frames of each channel, [frames, bins]
+        self.wv = wv  # [samples, 2]
+
+
+class PieceEditor:
+    # Regenerates only the windows of a piece whose coordinates change.
+    # Generator windows are independent and the decoders work on 8-column latent chunks, so unchanged
+    # windows are reused as they are; only the iSTFT overlap into the neighbouring windows is recomputed.
+    def __init__(self, U, gen_ema, dec, dec2, batch_size=64):
+        self.U = U
+        self.args = U.args
+        self.gen_ema = gen_ema
+        self.dec = dec
+        self.dec2 = dec2
+        self.batch_size = batch_size
+
+    def decode_windows(self, lat):
+        abls = tf.split(lat, lat.shape[0], 0)
+        ab = tf.concat(abls, -2)
+        abls = tf.split(ab, ab.shape[-2] // 8, -2)
+        abi = tf.concat(abls, 0)
+        return [np.array(SP) for SP in self.U.decode_specphase(abi, self.dec, self.dec2, self.batch_size)]
+
+    def render(self, fac, var=1.8, seed=None):
+        anchors = self.U.get_noise_anchors(fac, var, seed)
+        coords = self.U.interp_anchors(anchors, fac)
+        lat = self.U.distribute_gen(coords, self.gen_ema, bs=self.batch_size)
+        specs = self.decode_windows(lat)
+        wv = np.stack([np.asarray(self.U.inverse_stft(SP)) for SP in specs], -1)
+        return Piece(anchors, var, fac, np.array(coords), np.array(lat), specs, np.clip(wv, -1.0, 1.0))
+
+    def anchors_in(self, piece, start, end):
+        # indices of the anchors that shape the audio between start and end seconds
+        col_samples = self.args.hop * self.args.shape // 8
+        c0 = self.args.latlen // 4 + start * self.args.sr / col_samples
+        c1 = self.args.latlen // 4 + end * self.args.sr / col_samples
+        return [
+            k
+            for k in range(len(piece.anchors))
+            if (k - 1) * self.args.coordlen - 1 < c1 and (k + 1) * self.args.coordlen > c0
+        ]
+
+    def reroll(self, piece, start, end, var=None, seed=None):
+        # resample the anchors between start and end seconds, optionally with a different truncation
+        var = piece.var if var is None else var
+        rng = tf.random.Generator.from_seed(seed) if seed is not None else None
+        noiseg = piece.anchors[0][:, 64:]
+        anchors = list(piece.anchors)
+        for k in self.anchors_in(piece, start, end):
+            anchors[k] = self.U.get_noise_anchor(noiseg, var, rng)
+        return self.set_anchors(piece, anchors)
+
+    def set_anchors(self, piece, anchors):
+        coords = np.array(self.U.interp_anchors(anchors, piece.fac))
+        changed = np.nonzero(np.any(coords != piece.coords, axis=(1, 2)))[0]
+        piece.anchors = anchors
+        piece.coords = coords
+        if len(changed) == 0:
+            return piece
+
+        lat = self.U.distribute_gen(tf.constant(coords[changed]), self.gen_ema, bs=self.batch_size)
+        piece.lat[changed] = np.array(lat)
+
+        specs = self.decode_windows(lat)
+        frames = piece.specs[0].shape[0] // piece.fac
+        for i, w in enumerate(changed):
+            for channel in range(2):
+                piece.specs[channel][w * frames : (w + 1) * frames] = specs[channel][i * frames : (i + 1) * frames]
+
+        for run in np.split(changed, np.nonzero(np.diff(changed) > 1)[0] + 1):
+            self.splice(piece, run[0] * frames, (run[-1] + 1) * frames)
+        return piece
+
+    def splice(self, piece, a, b):
+        # output block k only depends on frames k-3..k: recompute blocks a..b+2 from frames a-3..b+2
+        hop = self.args.hop
+        nframes = piece.specs[0].shape[0]
+        s = max(a - 3, 0)
+        e = min(b + 3, nframes)
+        end = min(b + 3, nframes + 3)
+        for channel in range(2):
+            wv = np.asarray(self.U.inverse_stft(piece.specs[channel][s:e]))
+            piece.wv[a * hop : end * hop, channel] = np.clip(wv[(a - s) * hop : (end - s) * hop], -1.0, 1.0)
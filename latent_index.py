@@ -0,0 +1,144 @@
+import os
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+
+import time
+from glob import glob
+
+import numpy as np
+
+
+INDEX_QUERIES = 8
+INDEX_TRUNCATION = 1.8
+
+
+class LatentIndex:
+    # Nearest-neighbour search over latent windows (ENC/ENC2 latents of the corpus, gen_ema outputs for
+    # generated pieces). Each window is pooled into its mean and standard deviation over time and
+    # L2-normalized, so a matmul gives cosine similarities.
+    def __init__(self, window, stride, quantize=False):
+        self.window = window
+        self.stride = stride
+        self.quantize = quantize
+        self.vectors = []
+        self.scales = []
+        self.keys = []
+        self.offsets = []
+
+    def embed(self, lat):
+        # lat [T, 2*latdepth] -> [n, 4*latdepth], one vector every stride columns
+        lat = np.asarray(lat, dtype=np.float32).reshape(-1, lat.shape[-1])
+        if lat.shape[0] < self.window:
+            return np.zeros([0, lat.shape[-1] * 2], dtype=np.float32), np.zeros([0], dtype=np.int64)
+        starts = np.arange(0, lat.shape[0] - self.window + 1, self.stride)
+        windows = np.lib.stride_tricks.sliding_window_view(lat, self.window, axis=0)[starts]
+        vecs = np.concatenate([windows.mean(-1), windows.std(-1)], -1)
+        vecs /= np.linalg.norm(vecs, axis=-1, keepdims=True) + 1e-8
+        return vecs, starts
+
+    def add(self, lat, key):
+        vecs, starts = self.embed(lat)
+        if self.quantize:
+            # symmetric per-vector int8
+            scale = np.abs(vecs).max(-1, keepdims=True) / 127.0 + 1e-12
+            self.vectors.append(np.round(vecs / scale).astype(np.int8))
+            self.scales.append(scale[:, 0].astype(np.float32))
+        else:
+            self.vectors.append(vecs)
+        self.keys.extend([key] * len(starts))
+        self.offsets.append(starts)
+
+    def finalize(self):
+        self.vectors = np.concatenate(self.vectors, 0)
+        self.scales = np.concatenate(self.scales, 0) if self.quantize else None
+        self.keys = np.array(self.keys)
+        self.offsets = np.concatenate(self.offsets, 0)
+
+    def search(self, queries, k=5, block=65536):
+        # queries [q, D] -> (scores [q, k], indices [q, k]), best first; the corpus is scored in blocks
+        queries = np.asarray(queries, dtype=np.float32)
+        best_s = np.full([queries.shape[0], 0], -np.inf, dtype=np.float32)
+        best_i = np.zeros([queries.shape[0], 0], dtype=np.int64)
+        for b in range(0, self.vectors.shape[0], block):
+            scores = queries @ self.vectors[b : b + block].astype(np.float32).T
+            if self.quantize:
+                scores *= self.scales[b : b + block]
+            scores = np.concatenate([best_s, scores], -1)
+            n = scores.shape[-1] - best_i.shape[-1]
+            idx = np.concatenate([best_i, np.broadcast_to(np.arange(b, b + n), (queries.shape[0], n))], -1)
+            kk = min(k, scores.shape[-1])
+            top = np.argpartition(-scores, kk - 1, -1)[:, :kk]
+            best_s = np.take_along_axis(scores, top, -1)
+            best_i = np.take_along_axis(idx, top, -1)
+        order = np.argsort(-best_s, -1)
+        return np.take_along_axis(best_s, order, -1), np.take_along_axis(best_i, order, -1)
+
+    def save(self, path):
+        np.savez(
+            path,
+            window=self.window,
+            stride=self.stride,
+            quantize=self.quantize,
+            vectors=self.vectors,
+            scales=self.scales if self.quantize else np.zeros([0], dtype=np.float32),
+            keys=self.keys,
+            offsets=self.offsets,
+        )
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        index = cls(int(data["window"]), int(data["stride"]), bool(data["quantize"]))
+        index.vectors = data["vectors"]
+        index.scales = data["scales"] if index.quantize else None
+        index.keys = data["keys"]
+        index.offsets = data["offsets"]
+        return index
+
+
+def build_index(args, quantize=False):
+    index = LatentIndex(args.latlen, args.latlen // 4, quantize)
+    for p in sorted(glob(args.train_path + "/*.npy")):
+        index.add(np.load(p, mmap_mode="r"), os.path.basename(p))
+    index.finalize()
+    return index
+
+
+if __name__ == "__main__":
+
+    from parse_test import parse_args
+
+    import tensorflow as tf
+    from models import Models_functions
+    from utils import Utils_functions
+    from constants import GENRES
+
+    # parse args
+    args = parse_args()
+
+    if os.path.exists(args.index_path):
+        index = LatentIndex.load(args.index_path)
+    else:
+        bef = time.time()
+        index = build_index(args, args.index_quantize)
+        index.save(args.index_path)
+        print(f"Indexed {index.vectors.shape[0]} windows in {time.time() - bef:.2f} s")
+
+    # check generated pieces of every checkpoint against the corpus
+    M = Models_functions(args)
+    U = Utils_functions(args)
+    col_seconds = args.hop * args.shape / 8 / args.sr
+    for genre, models_ls in zip(GENRES, M.get_networks()):
+        critic, gen, enc, dec, enc2, dec2, gen_ema, [opt_dec, opt_disc], switch = models_ls
+        queries = []
+        for seed in range(INDEX_QUERIES):
+            lat = U.distribute_gen(U.get_noise_interp_multi(1, INDEX_TRUNCATION, seed=seed), gen_ema)
+            queries.append(index.embed(tf.concat(tf.split(lat, lat.shape[0], 0), -2)[0, 0])[0])
+        queries = np.concatenate(queries, 0)
+
+        bef = time.time()
+        scores, idx = index.search(queries, args.index_topk)
+        print(f"{genre}: {queries.shape[0]} windows searched in {(time.time() - bef) * 1000:.1f} ms")
+        for q in np.argsort(-scores[:, 0])[: args.index_topk]:
+            i = idx[q, 0]
+            print(f"    {scores[q, 0]:.4f}  {index.keys[i]} at {index.offsets[i] * col_seconds:.1f}s")
@@ -18,6 +18,8 @@ class ConvSN2D(tf.keras.layers.Conv2D):
         super(ConvSN2D, self).__init__(filters, kernel_size, **kwargs)
         self.power_iterations = power_iterations
         self.datatype = datatype
+        self.frozen = False
+        self.frozen_kernel = None
 
     def build(self, input_shape):
         super(ConvSN2D, self).build(input_shape)
@@ -49,10 +51,24 @@ class ConvSN2D(tf.keras.layers.Conv2D):
 
         return W_bar
 
-    def call(self, inputs):
+    def freeze(self):
+        # normalize the kernel once for inference into a separate tensor, the raw kernel is kept
         W_shape = self.kernel.shape.as_list()
         W_reshaped = tf.reshape(self.kernel, (-1, W_shape[-1]))
-        new_kernel = self.compute_spectral_norm(W_reshaped, self.u, W_shape)
+        self.frozen_kernel = self.compute_spectral_norm(W_reshaped, self.u, W_shape)
+        self.frozen = True
+
+    def unfreeze(self):
+        self.frozen_kernel = None
+        self.frozen = False
+
+    def call(self, inputs):
+        if self.frozen:
+            new_kernel = tf.cast(self.frozen_kernel, self._compute_dtype)
+        else:
+            W_shape = self.kernel.shape.as_list()
+            W_reshaped = tf.reshape(self.kernel, (-1, W_shape[-1]))
+            new_kernel = self.compute_spectral_norm(W_reshaped, self.u, W_shape)
         outputs = self._convolution_op(inputs, new_kernel)
 
         if self.use_bias:
@@ -70,6 +86,8 @@ class DenseSN(tf.keras.layers.Dense):
     def __init__(self, datatype=tf.float32, **kwargs):
         super(DenseSN, self).__init__(**kwargs)
         self.datatype = datatype
+        self.frozen = False
+        self.frozen_kernel = None
 
     def build(self, input_shape):
         super(DenseSN, self).build(input_shape)
@@ -91,10 +109,24 @@ class DenseSN(tf.keras.layers.Dense):
             W_bar = tf.reshape(W_bar, W_shape)
         return W_bar
 
-    def call(self, inputs):
+    def freeze(self):
+        # normalize the kernel once for inference into a separate tensor, the raw kernel is kept
         W_shape = self.kernel.shape.as_list()
         W_reshaped = tf.reshape(self.kernel, (-1, W_shape[-1]))
-        new_kernel = self.compute_spectral_norm(W_reshaped, self.u, W_shape)
+        self.frozen_kernel = self.compute_spectral_norm(W_reshaped, self.u, W_shape)
+        self.frozen = True
+
+    def unfreeze(self):
+        self.frozen_kernel = None
+        self.frozen = False
+
+    def call(self, inputs):
+        if self.frozen:
+            new_kernel = tf.cast(self.frozen_kernel, self._compute_dtype)
+        else:
+            W_shape = self.kernel.shape.as_list()
+            W_reshaped = tf.reshape(self.kernel, (-1, W_shape[-1]))
+            new_kernel = self.compute_spectral_norm(W_reshaped, self.u, W_shape)
         rank = len(inputs.shape)
         if rank > 2:
             outputs = standard_ops.tensordot(inputs, new_kernel, [[rank - 1], [0]])
@@ -119,6 +151,8 @@ class AddNoise(tf.keras.layers.Layer):
     def __init__(self, datatype=tf.float32, **kwargs):
         super(AddNoise, self).__init__(**kwargs)
         self.datatype = datatype
+        self.active = True
+        self.noise_bank = None
 
     def build(self, input_shape):
         self.b = self.add_weight(
@@ -129,14 +163,30 @@ class AddNoise(tf.keras.layers.Layer):
             trainable=True,
             name="noise_weight",
         )
+        self.noise_shape = [input_shape[1], input_shape[2]]
 
-    def call(self, inputs):
-        rand = tf.random.normal(
-            [tf.shape(inputs)[0], inputs.shape[1], inputs.shape[2], 1],
-            mean=0.0,
-            stddev=1.0,
+    def set_noise_bank(self, bank_size, seed):
+        # fixed, seeded noise reused across calls instead of sampling every forward pass
+        self.noise_bank = tf.random.stateless_normal(
+            [bank_size, self.noise_shape[0], self.noise_shape[1], 1],
+            [seed, 0],
             dtype=self.datatype,
         )
+
+    def call(self, inputs):
+        if not self.active:
+            return inputs
+        if self.noise_bank is not None:
+            # random maps of the bank on every call, so pieces do not share the same noise
+            idx = tf.random.uniform([tf.shape(inputs)[0]], 0, self.noise_bank.shape[0], dtype=tf.int32)
+            rand = tf.gather(self.noise_bank, idx)
+        else:
+            rand = tf.random.normal(
+                [tf.shape(inputs)[0], inputs.shape[1], inputs.shape[2], 1],
+                mean=0.0,
+                stddev=1.0,
+                dtype=self.datatype,
+            )
         output = inputs + self.b * rand
         return output
 
@@ -0,0 +1,158 @@
+import json
+import time
+import random
+import argparse
+import threading
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from constants import GENRES
+
+
+def post_json(url, obj, timeout):
+    req = urllib.request.Request(
+        url, data=json.dumps(obj).encode(), headers={"Content-Type": "application/json"}, method="POST"
+    )
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as r:
+            return r.status, json.loads(r.read() or b"{}")
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read() or b"{}")
+
+
+def get_url(url, timeout):
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as r:
+            return r.status, r.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+def request_api(args, job):
+    # submit to the job API, poll until the job finishes and download the result
+    code, status = post_json(args.url + "/jobs", job, args.timeout)
+    if code != 202:
+        return {"ok": False, "error": f"{code} {status.get('error', '')}"}
+    while status.get("status") in ("queued", "running"):
+        time.sleep(args.poll)
+        code, body = get_url(f"{args.url}/jobs/{status['id']}", args.timeout)
+        status = json.loads(body)
+    if status.get("status") != "done":
+        return {"ok": False, "error": f"{status.get('status')} {status.get('error', '')}", **status}
+    code, body = get_url(f"{args.url}/jobs/{status['id']}/result", args.timeout)
+    return {"ok": code == 200, "error": None if code == 200 else str(code), "bytes": len(body), **status}
+
+
+def request_gradio(args, job):
+    code, out = post_json(
+        args.url + "/api/predict",
+        {"data": [GENRES[job["genre"]], job["duration"], job["truncation"]]},
+        args.timeout,
+    )
+    if code != 200 or "error" in out:
+        return {"ok": False, "error": f"{code} {out.get('error', '')}"}
+    return {"ok": True, "error": None}
+
+
+def sample_job(rng, args):
+    return {
+        "genre": rng.choice(args.genres),
+        "duration": rng.choice(args.durations),
+        "truncation": rng.choice(args.truncations),
+        "seed": rng.randrange(2**31),
+    }
+
+
+def run_level(args, concurrency):
+    # closed loop: every worker sends its next request as soon as the previous one returns
+    rng = random.Random(args.seed + concurrency)
+    jobs = [sample_job(rng, args) for _ in range(args.requests)]
+    fn = request_api if args.target == "api" else request_gradio
+    results = []
+    lock = threading.Lock()
+
+    def one(job):
+        bef = time.time()
+        try:
+            res = fn(args, job)
+        except (OSError, ValueError) as e:
+            res = {"ok": False, "error": repr(e)}
+        res["latency"] = time.time() - bef
+        with lock:
+            results.append(res)
+
+    bef = time.time()
+    with ThreadPoolExecutor(concurrency) as ex:
+        list(ex.map(one, jobs))
+    elapsed = time.time() - bef
+
+    ok = [r for r in results if r["ok"]]
+    lat = np.array([r["latency"] for r in ok]) if ok else np.zeros([1])
+    waits = [r["queue_wait"] for r in ok if "queue_wait" in r]
+    return {
+        "concurrency": concurrency,
+        "throughput": len(ok) / elapsed,
+        "p50": float(np.percentile(lat, 50)),
+        "p95": float(np.percentile(lat, 95)),
+        "p99": float(np.percentile(lat, 99)),
+        "errors": 1.0 - len(ok) / len(results),
+        "queue_wait": float(np.mean(waits)) if waits else float("nan"),
+        "first_error": next((r["error"] for r in results if not r["ok"]), None),
+    }
+
+
+def find_knee(rows, gain=0.05):
+    # last level before adding concurrency stops raising throughput by more than gain
+    for prev, row in zip(rows, rows[1:]):
+        if row["throughput"] < prev["throughput"] * (1.0 + gain) or row["errors"] > 0.0:
+            return prev
+    return rows[-1]
+
+
+def parse_loadtest_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target", type=str, default="api", choices=["api", "gradio"], help="Endpoint to drive")
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:8000", help="Base URL of the local instance")
+    parser.add_argument("--levels", type=str, default="1,2,4,8,16", help="Comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=32, help="Requests sent at each concurrency level")
+    parser.add_argument("--genres", type=str, default="0,1,2", help="Comma-separated genre indices of the mix")
+    parser.add_argument("--durations", type=str, default="23,60,118", help="Comma-separated durations in seconds")
+    parser.add_argument("--truncations", type=str, default="1.2,1.8,2.5", help="Comma-separated truncations")
+    parser.add_argument("--timeout", type=float, default=600.0, help="Seconds before a request is counted as failed")
+    parser.add_argument("--poll", type=float, default=0.2, help="Seconds between job status polls (api target)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the request mix")
+    args = parser.parse_args()
+    args.url = args.url.rstrip("/")
+    args.levels = [int(c) for c in args.levels.split(",")]
+    args.genres = [int(g) for g in args.genres.split(",")]
+    args.durations = [float(d) for d in args.durations.split(",")]
+    args.truncations = [float(t) for t in args.truncations.split(",")]
+    return args
+
+
+if __name__ == "__main__":
+
+    # e.g. python api.py & python loadtest.py --target api
+    # or   python app.py & python loadtest.py --target gradio --url http://127.0.0.1:7860
+    args = parse_loadtest_args()
+
+    rows = []
+    print(f"{'conc':>5} {'req/s':>7} {'p50 (s)':>8} {'p95 (s)':>8} {'p99 (s)':>8} {'errors':>7} {'wait (s)':>9}")
+    for c in args.levels:
+        row = run_level(args, c)
+        rows.append(row)
+        print(
+            f"{c:>5} {row['throughput']:>7.3f} {row['p50']:>8.2f} {row['p95']:>8.2f} {row['p99']:>8.2f} "
+            f"{row['errors'] * 100:>6.1f}% {row['queue_wait']:>9.2f}"
+        )
+        if row["first_error"] is not None:
+            print(f"      first error: {row['first_error']}")
+
+    knee = find_knee(rows)
+    print()
+    print(
+        f"Knee at concurrency {knee['concurrency']}: {knee['throughput']:.3f} req/s, p95 {knee['p95']:.2f} s"
+    )
@@ -0,0 +1,37 @@
+import threading
+import numpy as np
+
+
+class Metrics:
+    # thread-safe store of serving measurements (latencies in seconds, counters)
+    def __init__(self, maxlen=1000):
+        self.maxlen = maxlen
+        self.lock = threading.Lock()
+        self.values = {}
+        self.counters = {}
+
+    def record(self, name, value):
+        with self.lock:
+            ls = self.values.setdefault(name, [])
+            ls.append(float(value))
+            if len(ls) > self.maxlen:
+                del ls[0]
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self):
+        with self.lock:
+            out = {}
+            for name, ls in self.values.items():
+                arr = np.array(ls)
+                out[name] = {
+                    "count": len(ls),
+                    "mean": float(np.mean(arr)),
+                    "p50": float(np.percentile(arr, 50)),
+                    "p95": float(np.percentile(arr, 95)),
+                    "max": float(np.max(arr)),
+                }
+            out.update(self.counters)
+        return out
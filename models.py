@@ -1,8 +1,23 @@
+import time
 import numpy as np
 import tensorflow as tf
 from tensorflow.python.keras.utils.layer_utils import count_params
 
-from layers import AddNoise
+from layers import AddNoise, ConvSN2D, DenseSN
+from checkpoint import is_sharded, load_sharded, assign_parallel
+
+
+class JitModel:
+    # XLA-compiled inference forward pass, traced once per input shape
+    def __init__(self, model):
+        self.model = model
+        self.forward = tf.function(lambda x: model(x, training=False), jit_compile=True)
+
+    def __call__(self, x, training=False):
+        return self.forward(x)
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
 
 
 class Models_functions:
@@ -14,6 +29,11 @@ class Models_functions:
             self.mixed_precision = tf.keras.mixed_precision
             self.policy = tf.keras.mixed_precision.Policy("mixed_float16")
             tf.keras.mixed_precision.set_global_policy(self.policy)
+        elif self.args.precision == "bf16":
+            self.policy = tf.keras.mixed_precision.Policy("mixed_bfloat16")
+            tf.keras.mixed_precision.set_global_policy(self.policy)
+        else:
+            tf.keras.mixed_precision.set_global_policy("float32")
         self.init = tf.keras.initializers.he_uniform()
 
     def conv_util(
@@ -627,6 +647,125 @@ class Models_functions:
 
         return tf.keras.Model(inpf, gf, name="GEN")
 
+    def freeze_spectral_norm(self, model):
+        frozen = 0
+        for layer in model.layers:
+            if isinstance(layer, (ConvSN2D, DenseSN)):
+                layer.freeze()
+                frozen += 1
+        return frozen
+
+    def optimize_noise(self, model):
+        noise_layers = [layer for layer in model.layers if isinstance(layer, AddNoise)]
+        pruned = 0
+        for i, layer in enumerate(noise_layers):
+            if abs(float(layer.b.numpy()[0])) < self.args.noise_threshold:
+                layer.active = False
+                pruned += 1
+            elif self.args.noise_bank > 0:
+                layer.set_noise_bank(self.args.noise_bank, self.args.noise_seed + i)
+        if noise_layers and self.args.noise_threshold > 0.0:
+            print(f"{model.name}: pruned {pruned} of {len(noise_layers)} noise layers")
+        return pruned
+
+    def fold_inference_graph(self, model):
+        # fold inference-mode BatchNormalization into the preceding convolution
+        # and fuse a following swish into the convolution's bias-add + activation
+        folds = {}
+        folded = {}
+        for layer in model.layers:
+            if not layer.inbound_nodes or isinstance(layer.inbound_nodes[0].inbound_layers, list):
+                continue
+            inbound = layer.inbound_nodes[0].inbound_layers
+            if len(inbound.outbound_nodes) != 1:
+                continue
+            if inbound.name in folded:
+                conv = folded[inbound.name]
+            elif (
+                isinstance(inbound, tf.keras.layers.Conv2D)
+                and not isinstance(inbound, ConvSN2D)
+                and inbound.get_config()["activation"] == "linear"
+            ):
+                conv = inbound
+            else:
+                continue
+            fold = folds.get(conv.name, {})
+            if isinstance(layer, tf.keras.layers.BatchNormalization) and not fold:
+                folds[conv.name] = {"bn": layer}
+                folded[layer.name] = conv
+            elif str(getattr(layer, "symbol", "")).endswith(("swish", "silu")) and "act" not in fold:
+                folds.setdefault(conv.name, {})["act"] = layer
+                folded[layer.name] = conv
+
+        if not folds:
+            return model
+
+        def clone_fn(layer):
+            if layer.name in folded:
+                return tf.keras.layers.Activation("linear", name=layer.name)
+            if layer.name in folds:
+                config = layer.get_config()
+                config["use_bias"] = True
+                if "act" in folds[layer.name]:
+                    config["activation"] = "swish"
+                return layer.__class__.from_config(config)
+            return layer
+
+        new_model = tf.keras.models.clone_model(model, clone_function=clone_fn)
+
+        for name, fold in folds.items():
+            conv = model.get_layer(name)
+            kernel = conv.kernel.numpy()
+            bias = conv.bias.numpy() if conv.use_bias else np.zeros([conv.filters], dtype=kernel.dtype)
+            if "bn" in fold:
+                bn = fold["bn"]
+                gamma = bn.gamma.numpy() if bn.scale else 1.0
+                beta = bn.beta.numpy() if bn.center else 0.0
+                scale = gamma / np.sqrt(bn.moving_variance.numpy() + bn.epsilon)
+                if isinstance(conv, tf.keras.layers.Conv2DTranspose):
+                    kernel = kernel * scale[:, None]
+                else:
+                    kernel = kernel * scale
+                bias = (bias - bn.moving_mean.numpy()) * scale + beta
+            new_model.get_layer(name).set_weights([kernel, bias])
+
+        if not self.verify_rewrite(model, new_model):
+            print(f"{model.name}: folded graph does not match the original, keeping the original")
+            return model
+        print(f"{model.name}: folded {len(folds)} convolutions")
+        return new_model
+
+    def verify_rewrite(self, model, new_model, bs=2):
+        tol = 1e-3 if self.args.datatype == tf.float32 else 5e-2
+        inp = tf.random.normal([bs] + list(model.input_shape[1:]))
+        # compare without noise injection, restoring each layer's state afterwards
+        noise_layers = list(
+            {id(layer): layer for m in (model, new_model) for layer in m.layers if isinstance(layer, AddNoise)}.values()
+        )
+        active = [layer.active for layer in noise_layers]
+        try:
+            for layer in noise_layers:
+                layer.active = False
+            out = model(inp, training=False)
+            new_out = new_model(inp, training=False)
+        finally:
+            for layer, a in zip(noise_layers, active):
+                layer.active = a
+        if not isinstance(out, list):
+            out, new_out = [out], [new_out]
+        for a, b in zip(out, new_out):
+            a, b = np.asarray(a, dtype=np.float32), np.asarray(b, dtype=np.float32)
+            if np.max(np.abs(a - b)) > tol * (1.0 + np.max(np.abs(a))):
+                return False
+        return True
+
+    # Inference-only rewrites, applied once weights are loaded
+    def prepare_inference(self, model):
+        self.freeze_spectral_norm(model)
+        model = self.fold_inference_graph(model)
+        self.optimize_noise(model)
+        return model
+
     # Load past models from path to resume training or test
     def load(self, path, load_dec=False):
         gen = self.build_generator()
@@ -652,6 +791,30 @@ class Models_functions:
             enc.load_weights(self.args.dec_path + "/enc.h5")
             enc2.load_weights(self.args.dec_path + "/enc2.h5")
 
+        elif is_sharded(path):
+            # no dummy step: create the optimizer slots directly and fill every variable from the mapped shards
+            bef = time.time()
+            groups = ["gen_ema"] + (["critic"] if self.args.best_of > 1 else []) if self.args.testing else None
+            weights = load_sharded(path, groups)
+            pairs = list(zip(gen_ema.weights, weights["gen_ema"]))
+            if self.args.testing and self.args.best_of > 1:
+                pairs += list(zip(critic.weights, weights["critic"]))
+            if not self.args.testing:
+                getattr(opt_disc, "inner_optimizer", opt_disc)._create_all_weights(critic.trainable_weights)
+                getattr(opt_dec, "inner_optimizer", opt_dec)._create_all_weights(gen.trainable_variables)
+                pairs += list(zip(critic.weights, weights["critic"]))
+                pairs += list(zip(gen.weights, weights["gen"]))
+                opt_disc.set_weights(weights["opt_disc"])
+                opt_dec.set_weights(weights["opt_dec"])
+                switch = tf.Variable(float(weights["switch"][0]), dtype=tf.float32)
+            assign_parallel(pairs)
+            print(f"Checkpoint loaded from {path} in {time.time() - bef:.2f} s")
+
+            dec.load_weights(self.args.dec_path + "/dec.h5")
+            dec2.load_weights(self.args.dec_path + "/dec2.h5")
+            enc.load_weights(self.args.dec_path + "/enc.h5")
+            enc2.load_weights(self.args.dec_path + "/enc2.h5")
+
         else:
             grad_vars = critic.trainable_weights
             zero_grads = [tf.zeros_like(w) for w in grad_vars]
@@ -667,6 +830,9 @@ class Models_functions:
                 critic.load_weights(path + "/critic.h5")
                 gen.load_weights(path + "/gen.h5")
                 switch = tf.Variable(float(np.load(path + "/switch.npy", allow_pickle=True)), dtype=tf.float32)
+            elif self.args.best_of > 1:
+                # the critic scores candidate latents in best-of-N generation
+                critic.load_weights(path + "/critic.h5")
 
             gen_ema.load_weights(path + "/gen_ema.h5")
             dec.load_weights(self.args.dec_path + "/dec.h5")
@@ -674,6 +840,13 @@ class Models_functions:
             enc.load_weights(self.args.dec_path + "/enc.h5")
             enc2.load_weights(self.args.dec_path + "/enc2.h5")
 
+        if self.args.testing:
+            gen_ema = self.prepare_inference(gen_ema)
+            dec = self.prepare_inference(dec)
+            dec2 = self.prepare_inference(dec2)
+            enc = self.prepare_inference(enc)
+            enc2 = self.prepare_inference(enc2)
+
         return (
             critic,
             gen,
@@ -721,7 +894,7 @@ class Models_functions:
 
     def get_networks(self):
         (
-            critic,
+            critic_1,
             gen,
             enc,
             dec,
@@ -734,7 +907,7 @@ class Models_functions:
         print(f"Networks loaded from {self.args.load_path_1}")
 
         (
-            critic,
+            critic_2,
             gen,
             enc,
             dec,
@@ -747,7 +920,7 @@ class Models_functions:
         print(f"Networks loaded from {self.args.load_path_2}")
 
         (
-            critic,
+            critic_3,
             gen,
             enc,
             dec,
@@ -759,10 +932,18 @@ class Models_functions:
         ) = self.load(self.args.load_path_3, load_dec=False)
         print(f"Networks loaded from {self.args.load_path_3}")
 
+        if self.args.jit:
+            dec = JitModel(dec)
+            dec2 = JitModel(dec2)
+            gen_ema_1 = JitModel(gen_ema_1)
+            gen_ema_2 = JitModel(gen_ema_2)
+            gen_ema_3 = JitModel(gen_ema_3)
+            print("Generators and decoders will be compiled with XLA")
+
         return (
-            (critic, gen, enc, dec, enc2, dec2, gen_ema_1, [opt_dec, opt_disc], switch),
-            (critic, gen, enc, dec, enc2, dec2, gen_ema_2, [opt_dec, opt_disc], switch),
-            (critic, gen, enc, dec, enc2, dec2, gen_ema_3, [opt_dec, opt_disc], switch),
+            (critic_1, gen, enc, dec, enc2, dec2, gen_ema_1, [opt_dec, opt_disc], switch),
+            (critic_2, gen, enc, dec, enc2, dec2, gen_ema_2, [opt_dec, opt_disc], switch),
+            (critic_3, gen, enc, dec, enc2, dec2, gen_ema_3, [opt_dec, opt_disc], switch),
         )
 
     def initialize_networks(self):
@@ -5,6 +5,7 @@ os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
 from parse_test import parse_args
 from models import Models_functions
 from utils import Utils_functions
+from reload import watch_checkpoints
 
 if __name__ == "__main__":
 
@@ -17,4 +18,6 @@ if __name__ == "__main__":
 
     # test musika
     U = Utils_functions(args)
-    U.render_gradio(models_ls_1, models_ls_2, models_ls_3, train=False)
+    models_ls = [models_ls_1, models_ls_2, models_ls_3]
+    watch_checkpoints(M, models_ls, U.metrics)
+    U.render_gradio(models_ls, train=False)
@@ -1,6 +1,11 @@
+import os
+import sys
 import argparse
 from typing import Any
-import tensorflow as tf
+from importlib.metadata import version, PackageNotFoundError
+
+
+MONO_MODES = ["none", "mid", "left"]
 
 
 class EasyDict(dict):
@@ -28,8 +33,50 @@ def str2bool(v):
         raise argparse.ArgumentTypeError("Boolean value expected.")
 
 
+# XLA flags are read when TensorFlow is imported, so these arguments are parsed before the import
+def jit_parser():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        "--jit",
+        type=str2bool,
+        default=False,
+        help="True to compile generator and decoders with XLA",
+    )
+    parser.add_argument(
+        "--xla_cache_dir",
+        type=str,
+        default="xla_cache/",
+        help="Directory of the persistent XLA compilation cache (TensorFlow 2.11 or newer)",
+    )
+    return parser
+
+
+def tf_version():
+    for name in ["tensorflow", "tensorflow-cpu", "tensorflow-gpu"]:
+        try:
+            return tuple(int(v) for v in version(name).split(".")[:2])
+        except (PackageNotFoundError, ValueError):
+            pass
+    return (0, 0)
+
+
+def set_xla_flags(argv):
+    jit_args, _ = jit_parser().parse_known_args(argv)
+    # older versions abort on the unknown --tf_xla_persistent_cache_directory flag
+    if jit_args.jit and tf_version() >= (2, 11):
+        os.makedirs(jit_args.xla_cache_dir, exist_ok=True)
+        os.environ["TF_XLA_FLAGS"] = (
+            os.environ.get("TF_XLA_FLAGS", "") + f" --tf_xla_persistent_cache_directory={jit_args.xla_cache_dir}"
+        ).strip()
+
+
+set_xla_flags(sys.argv[1:])
+
+import tensorflow as tf
+
+
 def params_args(args):
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(parents=[jit_parser()])
 
     parser.add_argument(
         "--hop",
@@ -139,6 +186,207 @@ def params_args(args):
         default=True,
         help="True if your GPU supports mixed precision",
     )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="fp32",
+        choices=["fp32", "bf16"],
+        help="Inference precision on CPU: fp32 or bf16 (bfloat16 generator and decoders, float32 iSTFT)",
+    )
+    parser.add_argument(
+        "--noise_threshold",
+        type=float,
+        default=0.0,
+        help="Noise injection layers with absolute weight below this value are skipped at inference",
+    )
+    parser.add_argument(
+        "--noise_bank",
+        type=int,
+        default=0,
+        help="Size of the precomputed noise bank used by noise injection layers at inference (0 samples fresh noise)",
+    )
+    parser.add_argument(
+        "--noise_seed",
+        type=int,
+        default=0,
+        help="Seed of the precomputed noise bank",
+    )
+    parser.add_argument(
+        "--stream",
+        type=str2bool,
+        default=False,
+        help="True to stream generated audio to the interface while the rest of the piece is generated",
+    )
+    parser.add_argument(
+        "--stream_chunks",
+        type=int,
+        default=8,
+        help="Latent chunks (about 0.74 s of audio each) decoded before the first streamed update",
+    )
+    parser.add_argument(
+        "--max_concurrent",
+        type=int,
+        default=1,
+        help="Maximum number of generation requests running at the same time",
+    )
+    parser.add_argument(
+        "--max_queued",
+        type=int,
+        default=8,
+        help="Maximum number of waiting generation requests, further requests are rejected",
+    )
+    parser.add_argument(
+        "--aging",
+        type=float,
+        default=1.0,
+        help="Seconds of estimated cost a waiting request gains in priority per second waited",
+    )
+    parser.add_argument(
+        "--api_host",
+        type=str,
+        default="127.0.0.1",
+        help="Host the headless job API listens on",
+    )
+    parser.add_argument(
+        "--api_port",
+        type=int,
+        default=8000,
+        help="Port the headless job API listens on",
+    )
+    parser.add_argument(
+        "--api_result_mb",
+        type=float,
+        default=1024.0,
+        help="Total size of finished job results kept by the job API, oldest jobs are forgotten first",
+    )
+    parser.add_argument(
+        "--api_result_ttl",
+        type=float,
+        default=3600.0,
+        help="Seconds a finished job and its results are kept by the job API",
+    )
+    parser.add_argument(
+        "--hot_reload",
+        type=str2bool,
+        default=False,
+        help="True to load new gen_ema.h5 weights from the checkpoint paths while serving",
+    )
+    parser.add_argument(
+        "--reload_interval",
+        type=float,
+        default=10.0,
+        help="Seconds between checks of the checkpoint paths for new weights",
+    )
+    parser.add_argument(
+        "--ckpt_format",
+        type=str,
+        default="h5",
+        choices=["h5", "sharded"],
+        help="Format of the checkpoints written during training: h5 or sharded (memory-mappable shards with a manifest)",
+    )
+    parser.add_argument(
+        "--ckpt_src",
+        type=str,
+        default="checkpoints/ep2",
+        help="Checkpoint directory to convert to the sharded format (checkpoint.py)",
+    )
+    parser.add_argument(
+        "--ckpt_dst",
+        type=str,
+        default="checkpoints/ep2_sharded",
+        help="Output directory of the converted sharded checkpoint (checkpoint.py)",
+    )
+    parser.add_argument(
+        "--train_path",
+        type=str,
+        default="training_samples",
+        help="Folder of encoded latent .npy files used for training",
+    )
+    parser.add_argument(
+        "--bs",
+        type=int,
+        default=32,
+        help="Batch size of the training dataset",
+    )
+    parser.add_argument(
+        "--shuffle_buffer",
+        type=int,
+        default=1024,
+        help="Number of crops in the shuffling buffer of the training dataset",
+    )
+    parser.add_argument(
+        "--cache_dataset",
+        type=str2bool,
+        default=True,
+        help="True to keep the loaded latent files in memory after the first epoch",
+    )
+    parser.add_argument(
+        "--bench_modes",
+        type=str,
+        default="jit,prune,bank",
+        help="Comma-separated modes compared against float32 by benchmark.py: mixed, bf16, jit, prune, bank, batch16, mono_mid, mono_left",
+    )
+    parser.add_argument(
+        "--bench_seeds",
+        type=int,
+        default=3,
+        help="Number of seeded pieces rendered per length by benchmark.py",
+    )
+    parser.add_argument(
+        "--bench_threshold",
+        type=float,
+        default=1.5,
+        help="Largest accepted spectral distance to the reference, as a multiple of the decoder noise floor",
+    )
+    parser.add_argument(
+        "--profile_facs",
+        type=str,
+        default="1,5,10",
+        help="Comma-separated numbers of windows (23s each) profiled by profile_memory.py",
+    )
+    parser.add_argument(
+        "--profile_bs",
+        type=str,
+        default="16,64",
+        help="Comma-separated decoder batch sizes profiled by profile_memory.py",
+    )
+    parser.add_argument(
+        "--profile_out",
+        type=str,
+        default="memory_profile.csv",
+        help="Output file of the memory curve written by profile_memory.py",
+    )
+    parser.add_argument(
+        "--index_path",
+        type=str,
+        default="latent_index.npz",
+        help="Latent similarity index of the files in train_path, built by latent_index.py if missing",
+    )
+    parser.add_argument(
+        "--index_quantize",
+        type=str2bool,
+        default=False,
+        help="True to store the index vectors as int8",
+    )
+    parser.add_argument(
+        "--index_topk",
+        type=int,
+        default=5,
+        help="Number of nearest corpus windows reported by latent_index.py",
+    )
+    parser.add_argument(
+        "--mono",
+        type=str,
+        default="none",
+        choices=MONO_MODES,
+        help="Decode a single channel: mid (average of the latent halves), left, or none for stereo",
+    )
+    parser.add_argument(
+        "--best_of",
+        type=int,
+        default=1,
+        help="Number of candidate pieces scored by the critic before decoding the best one (1 to disable)",
+    )
 
     tmp_args = parser.parse_args()
 
@@ -160,6 +408,45 @@ def params_args(args):
     args.testing = tmp_args.testing
     args.cpu = tmp_args.cpu
     args.mixed_precision = tmp_args.mixed_precision
+    args.precision = tmp_args.precision
+    args.jit = tmp_args.jit
+    args.xla_cache_dir = tmp_args.xla_cache_dir
+    args.noise_threshold = tmp_args.noise_threshold
+    args.noise_bank = tmp_args.noise_bank
+    args.noise_seed = tmp_args.noise_seed
+    args.stream = tmp_args.stream
+    args.stream_chunks = tmp_args.stream_chunks
+    args.max_concurrent = tmp_args.max_concurrent
+    args.max_queued = tmp_args.max_queued
+    args.aging = tmp_args.aging
+    args.api_host = tmp_args.api_host
+    args.api_port = tmp_args.api_port
+    args.api_result_mb = tmp_args.api_result_mb
+    args.api_result_ttl = tmp_args.api_result_ttl
+    args.hot_reload = tmp_args.hot_reload
+    args.reload_interval = tmp_args.reload_interval
+    args.ckpt_format = tmp_args.ckpt_format
+    args.ckpt_src = tmp_args.ckpt_src
+    args.ckpt_dst = tmp_args.ckpt_dst
+    args.train_path = tmp_args.train_path
+    args.bs = tmp_args.bs
+    args.shuffle_buffer = tmp_args.shuffle_buffer
+    args.cache_dataset = tmp_args.cache_dataset
+    args.bench_modes = tmp_args.bench_modes
+    args.bench_seeds = tmp_args.bench_seeds
+    args.bench_threshold = tmp_args.bench_threshold
+    args.profile_facs = tmp_args.profile_facs
+    args.profile_bs = tmp_args.profile_bs
+    args.profile_out = tmp_args.profile_out
+    args.index_path = tmp_args.index_path
+    args.index_quantize = tmp_args.index_quantize
+    args.index_topk = tmp_args.index_topk
+    args.mono = tmp_args.mono
+    args.best_of = tmp_args.best_of
+
+    if args.stream and args.best_of > 1:
+        # streaming decodes windows as they are generated, before all candidates can be scored
+        parser.error("--stream cannot be combined with --best_of > 1")
 
     if args.small:
         args.latlen = 128
@@ -167,6 +454,10 @@ def params_args(args):
         args.latlen = 256
     args.coordlen = (args.latlen // 2) * 3
 
+    if args.jit and tf_version() < (2, 11):
+        print()
+        print("Persistent XLA cache needs TensorFlow 2.11 or newer, compiling without it...")
+
     print()
 
     args.datatype = tf.float32
@@ -187,6 +478,17 @@ def params_args(args):
         print()
         print("Using GPU without mixed precision...")
         print()
+    if args.precision == "bf16":
+        if args.cpu:
+            args.datatype = tf.bfloat16
+            print()
+            print("Using CPU with bfloat16 precision...")
+            print()
+        else:
+            args.precision = "fp32"
+            print()
+            print("bfloat16 precision is only available on CPU, ignoring...")
+            print()
 
     return args
 
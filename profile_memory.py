@@ -0,0 +1,157 @@
+import os
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+
+import csv
+import time
+import threading
+from contextlib import contextmanager
+
+# parse_test sets the XLA flags before TensorFlow is imported
+from parse_test import parse_args
+
+import numpy as np
+import tensorflow as tf
+
+from benchmark import load_models
+from utils import Utils_functions
+
+
+def proc_status(key):
+    # value of a /proc/self/status entry in MB
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(key + ":"):
+                return int(line.split()[1]) / 1024.0
+    return 0.0
+
+
+def reset_peaks(device):
+    # writing 5 to clear_refs resets VmHWM to the current RSS (Linux >= 4.0)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+    try:
+        tf.config.experimental.reset_memory_stats(device)
+    except (ValueError, RuntimeError):
+        pass
+
+
+def tf_peak(device):
+    try:
+        return tf.config.experimental.get_memory_info(device)["peak"] / 2**20
+    except (ValueError, RuntimeError):
+        return float("nan")
+
+
+class MemoryProfiler:
+    # samples RSS in the background (memory curve) and records peak RSS and TF allocator peaks per stage
+    def __init__(self, device, interval=0.01):
+        self.device = device
+        self.interval = interval
+        self.stage_name = "idle"
+        self.curve = []
+        self.stages = []
+        self.start = time.time()
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+
+    def sample(self):
+        while self.running:
+            self.curve.append((time.time() - self.start, self.stage_name, proc_status("VmRSS")))
+            time.sleep(self.interval)
+
+    @contextmanager
+    def stage(self, name, **info):
+        reset_peaks(self.device)
+        rss = proc_status("VmRSS")
+        self.stage_name = name
+        bef = time.time()
+        try:
+            yield
+        finally:
+            # recorded even if the render raises, so the rest of the curve is not labelled with this stage
+            self.stages.append(
+                {
+                    **info,
+                    "stage": name,
+                    "time": time.time() - bef,
+                    "rss_before": rss,
+                    "rss_peak": proc_status("VmHWM"),
+                    "tf_peak": tf_peak(self.device),
+                }
+            )
+            self.stage_name = "idle"
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+
+def profile_request(U, P, models_ls, fac, bs):
+    # the serving path of a fac-window request, with every stage of generate_waveform recorded
+    critic, gen, enc, dec, enc2, dec2, gen_ema, [opt_dec, opt_disc], switch = models_ls
+    nfac, samples = U.duration_plan(fac * 23)
+    noiseinp = U.get_noise_interp_multi(nfac, 1.8)
+
+    U.stage_hook = lambda name: P.stage(name, fac=fac, bs=bs)
+    try:
+        return U.generate_waveform(
+            noiseinp, gen_ema, dec, dec2, batch_size=bs, dtype=np.int16, mono=U.args.mono, samples=samples
+        )
+    finally:
+        U.stage_hook = None
+
+
+def capacity_table(stages, baseline, budget_gb=1.0):
+    # max concurrent requests per GB for each duration, from the largest stage peak above the loaded models
+    rows = {}
+    for s in stages:
+        key = (s["fac"], s["bs"])
+        rows[key] = max(rows.get(key, 0.0), s["rss_peak"] - baseline)
+    print(f"{'length':>8} {'bs':>4} {'peak (MB)':>10} {'req/GB':>7}")
+    for (fac, bs), peak in sorted(rows.items()):
+        print(f"{fac * 23:>7}s {bs:>4} {peak:>10.1f} {int(budget_gb * 1024 // max(peak, 1.0)):>7}")
+
+
+if __name__ == "__main__":
+
+    # parse args
+    args = parse_args()
+
+    device = "CPU:0" if args.cpu else "GPU:0"
+    models_ls = load_models(args)
+    U = Utils_functions(args)
+    facs = [int(f) for f in args.profile_facs.split(",")]
+    bss = [int(b) for b in args.profile_bs.split(",")]
+
+    # one untimed request so that tracing and allocator pools are not counted as per-request memory
+    P = MemoryProfiler(device)
+    profile_request(U, P, models_ls, 1, bss[0])
+    P.stop()
+    baseline = proc_status("VmRSS")
+    print(f"Memory with loaded networks: {baseline:.1f} MB RSS")
+
+    P = MemoryProfiler(device)
+    for fac in facs:
+        for bs in bss:
+            profile_request(U, P, models_ls, fac, bs)
+    P.stop()
+
+    print(f"{'length':>8} {'bs':>4} {'stage':>19} {'time (s)':>9} {'RSS (MB)':>9} {'peak (MB)':>10} {'TF (MB)':>8}")
+    for s in P.stages:
+        print(
+            f"{s['fac'] * 23:>7}s {s['bs']:>4} {s['stage']:>19} {s['time']:>9.3f} {s['rss_before']:>9.1f} "
+            f"{s['rss_peak']:>10.1f} {s['tf_peak']:>8.1f}"
+        )
+    print()
+    capacity_table(P.stages, baseline)
+
+    with open(args.profile_out, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["time", "stage", "rss_mb"])
+        writer.writerows(P.curve)
+    print(f"Memory curve written to {args.profile_out}")
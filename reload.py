@@ -0,0 +1,88 @@
+import os
+import time
+import threading
+import tensorflow as tf
+
+from models import JitModel
+from checkpoint import MANIFEST, is_sharded, load_sharded, assign_parallel
+
+
+class CheckpointWatcher(threading.Thread):
+    # Polls the checkpoint directories and loads new gen_ema weights into a standby generator in the background.
+    # The entry in models_ls is then replaced in a single assignment: requests that already picked their
+    # models finish on the old weights, the next ones use the new ones.
+    def __init__(self, M, models_ls, paths, metrics, interval=10.0):
+        super(CheckpointWatcher, self).__init__(daemon=True)
+        self.M = M
+        self.args = M.args
+        self.models_ls = models_ls
+        self.paths = paths
+        self.metrics = metrics
+        self.interval = interval
+        self.mtimes = [self.mtime(path) for path in paths]
+        self.pending = [None for _ in paths]
+
+    def mtime(self, path):
+        try:
+            # the manifest of a sharded checkpoint is written after all of its shards
+            return os.path.getmtime(os.path.join(path, MANIFEST if is_sharded(path) else "gen_ema.h5"))
+        except OSError:
+            return None
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            for i, path in enumerate(self.paths):
+                mtime = self.mtime(path)
+                if mtime is None or mtime == self.mtimes[i]:
+                    self.pending[i] = None
+                elif mtime != self.pending[i]:
+                    # still being written or just changed: wait until it is stable for one interval
+                    self.pending[i] = mtime
+                else:
+                    self.mtimes[i] = mtime
+                    self.pending[i] = None
+                    try:
+                        self.reload(i, path)
+                    except Exception as e:
+                        self.metrics.count("reload_failed")
+                        print(f"Hot reload from {path} failed: {e!r}")
+
+    def reload(self, i, path):
+        bef = time.time()
+        gen_ema = self.M.build_generator()
+        critic, gen, enc, dec, enc2, dec2, _, [opt_dec, opt_disc], switch = self.models_ls[i]
+        if self.args.best_of > 1:
+            # keep the critic that scores best-of-N candidates in step with the generator
+            critic = self.M.build_critic()
+        if is_sharded(path):
+            weights = load_sharded(path, ["gen_ema"] + (["critic"] if self.args.best_of > 1 else []))
+            pairs = list(zip(gen_ema.weights, weights["gen_ema"]))
+            if self.args.best_of > 1:
+                pairs += list(zip(critic.weights, weights["critic"]))
+            assign_parallel(pairs)
+        else:
+            gen_ema.load_weights(path + "/gen_ema.h5")
+            if self.args.best_of > 1:
+                critic.load_weights(path + "/critic.h5")
+        gen_ema = self.M.prepare_inference(gen_ema)
+        if self.args.jit:
+            gen_ema = JitModel(gen_ema)
+        # warm up so that the first request on the new weights does not pay for tracing
+        gen_ema(tf.zeros([1, self.args.latlen, self.args.latdepth * 2]), training=False)
+
+        swap = time.time()
+        self.models_ls[i] = (critic, gen, enc, dec, enc2, dec2, gen_ema, [opt_dec, opt_disc], switch)
+        self.metrics.record("swap_latency", time.time() - swap)
+        self.metrics.record("reload_time", time.time() - bef)
+        print(f"Networks reloaded from {path} in {time.time() - bef:.2f} s")
+
+
+def watch_checkpoints(M, models_ls, metrics):
+    # with --hot_reload, swap in new gen_ema weights of the three checkpoints while serving
+    if not M.args.hot_reload:
+        return None
+    paths = [M.args.load_path_1, M.args.load_path_2, M.args.load_path_3]
+    watcher = CheckpointWatcher(M, models_ls, paths, metrics, M.args.reload_interval)
+    watcher.start()
+    return watcher
@@ -0,0 +1,67 @@
+import time
+import threading
+from contextlib import contextmanager
+
+from metrics import Metrics
+
+
+class SchedulerFull(Exception):
+    pass
+
+
+class Scheduler:
+    # admission control in front of generation: at most max_concurrent jobs run, at most max_queued wait,
+    # and the job with the lowest estimated cost runs first; waiting lowers a job's cost by aging per second
+    # so long jobs are not starved
+    def __init__(self, max_concurrent=1, max_queued=8, aging=1.0, metrics=None):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.aging = aging
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.cond = threading.Condition()
+        self.waiting = []
+        self.running = 0
+        self.seq = 0
+        self.rates = {}  # measured seconds per generated window, per genre
+
+    def estimate(self, genre, fac):
+        return self.rates.get(genre, 1.0) * fac
+
+    def next_job(self):
+        now = time.time()
+        return min(self.waiting, key=lambda job: (job["cost"] - self.aging * (now - job["arrival"]), job["seq"]))
+
+    def saturated(self):
+        with self.cond:
+            return len(self.waiting) >= self.max_queued
+
+    @contextmanager
+    def slot(self, genre, fac):
+        with self.cond:
+            if len(self.waiting) >= self.max_queued:
+                self.metrics.count("rejected")
+                raise SchedulerFull(
+                    f"Server is busy ({self.running} running, {len(self.waiting)} queued), please try again in a moment."
+                )
+            job = {"cost": self.estimate(genre, fac), "arrival": time.time(), "seq": self.seq}
+            self.seq += 1
+            self.waiting.append(job)
+            while self.running >= self.max_concurrent or self.next_job() is not job:
+                self.cond.wait()
+            self.waiting.remove(job)
+            self.running += 1
+            # another waiting job may fit in the remaining capacity
+            self.cond.notify_all()
+
+        start = time.time()
+        self.metrics.record("queue_wait", start - job["arrival"])
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            self.metrics.record("run_time", elapsed)
+            with self.cond:
+                self.running -= 1
+                rate = self.rates.get(genre, elapsed / fac)
+                self.rates[genre] = 0.8 * rate + 0.2 * elapsed / fac
+                self.cond.notify_all()
@@ -0,0 +1,79 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from parse_test import EasyDict
+from utils import Utils_functions
+
+
+# small shapes: 16 latent chunks per window, 32 frames per chunk
+def small_args():
+    args = EasyDict()
+    args.hop = 16
+    args.mel_bins = 8
+    args.sr = 8000
+    args.shape = 32
+    args.window = 8
+    args.latdepth = 4
+    args.latlen = 128
+    args.coordlen = (args.latlen // 2) * 3
+    args.mu_rescale = -25.0
+    args.sigma_rescale = 75.0
+    args.max_concurrent = 1
+    args.max_queued = 8
+    args.aging = 1.0
+    return args
+
+
+@pytest.fixture
+def U():
+    return Utils_functions(small_args())
+
+
+# stand-ins for the networks with the same input/output layout and outputs that depend on their inputs
+def fake_gen(args, offset=0.0):
+    # every window only depends on its own coordinates, as with the real generator
+    def gen(x, training=False):
+        pos = tf.reshape(tf.range(args.latlen * 2 * args.latdepth, dtype=tf.float32), [1, 1, args.latlen, -1])
+        shift = tf.reduce_sum(tf.reshape(tf.cast(x, tf.float32), [x.shape[0], -1]), -1)
+        return tf.sin((pos + shift[:, tf.newaxis, tf.newaxis, tf.newaxis] * 37.0 + offset) * 0.01)
+
+    return gen
+
+
+def fake_critic(args):
+    def critic(x, training=False):
+        return tf.reduce_mean(x, [1, 2, 3])[:, tf.newaxis]
+
+    return critic
+
+
+def fake_dec2(args):
+    # [2b, 1, 4, latdepth] halves -> [b, 1, shape, hop // 4], halves concatenated in time like DEC2
+    def dec2(x, training=False):
+        m = tf.reduce_mean(x, [2, 3], keepdims=True)
+        m = m * tf.linspace(0.5, 1.5, args.shape // 2)[tf.newaxis, tf.newaxis, :, tf.newaxis]
+        m = tf.broadcast_to(m, [x.shape[0], 1, args.shape // 2, args.hop // 4])
+        return tf.concat(tf.split(m, 2, 0), -2)
+
+    return dec2
+
+
+def fake_dec(args):
+    # [b, 1, shape // 2, hop // 4] -> magnitude and phase [b, shape // 2, 2 * hop + 1]
+    def dec(x, training=False):
+        m = tf.reduce_mean(x, -1)[:, 0, :, tf.newaxis]
+        m = tf.broadcast_to(m, [x.shape[0], args.shape // 2, 2 * args.hop + 1])
+        return tf.tanh(m) * 0.5, tf.tanh(m * 3.0)
+
+    return dec
+
+
+def chunk_samples(args, chunks):
+    # smallest number of samples that needs the given number of latent chunks
+    return (chunks - 1) * args.shape * args.hop + 1
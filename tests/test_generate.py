@@ -0,0 +1,117 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from conftest import fake_gen, fake_critic, fake_dec, fake_dec2, chunk_samples
+
+
+@pytest.mark.parametrize("chunks", [1, 63, 64, 65, 129])
+def test_decode_specphase_keeps_every_chunk(U, chunks):
+    abi = tf.random.normal([chunks, 1, 8, 2 * U.args.latdepth])
+    for SP in U.decode_specphase(abi, fake_dec(U.args), fake_dec2(U.args), batch_size=64):
+        assert SP.shape[0] == chunks * U.args.shape
+
+
+@pytest.mark.parametrize("bdim", [1, 2, 64, 65])
+def test_distribute_gen_partial_batch(U, bdim):
+    ab = U.distribute_gen(tf.zeros([bdim, 1]), fake_gen(U.args), bs=64)
+    assert ab.shape[0] == bdim
+
+
+@pytest.mark.parametrize("chunks", [1, 65])
+def test_generate_waveform_trimmed(U, chunks):
+    gen, dec, dec2 = fake_gen(U.args), fake_dec(U.args), fake_dec2(U.args)
+    fac = -(-chunks // (U.args.latlen // 8))
+    inp = tf.zeros([fac, 1])
+    samples = chunk_samples(U.args, chunks)
+    assert U.needed_chunks(samples) == chunks
+
+    full = U.generate_waveform(inp, gen, dec, dec2, batch_size=64)
+    out = U.generate_waveform(inp, gen, dec, dec2, batch_size=64, samples=samples)
+    assert out.shape == (samples, 2)
+    np.testing.assert_allclose(out, full[:samples], atol=1e-5)
+
+
+def test_generate_best_of_partial_batch(U, monkeypatch):
+    # n * fac = 65 windows go through gen_ema and the critic, one more than a full batch
+    monkeypatch.setattr(U, "get_noise_interp_multi", lambda fac, var, seed=None: tf.fill([fac, 1], float(seed)))
+    gen, dec, dec2 = fake_gen(U.args), fake_dec(U.args), fake_dec2(U.args)
+    fac, n = 5, 13
+    samples = chunk_samples(U.args, 70)
+
+    outs = U.generate_best_of(
+        fac, 1.8, gen, fake_critic(U.args), dec, dec2, n=n, k=2, batch_size=64, samples=samples, seed=0
+    )
+    assert len(outs) == 2
+    for out in outs:
+        assert out.shape == (samples, 2)
+        assert np.all(np.isfinite(out))
+    assert U.metrics.summary()["best_of_score"]["count"] == 1
+
+
+def test_generate_comparison_partial_batch(U):
+    # 3 generators x 43 chunks = 129 chunks in one decode batch
+    gens = [fake_gen(U.args, offset) for offset in (0.0, 1.0, 2.0)]
+    dec, dec2 = fake_dec(U.args), fake_dec2(U.args)
+    inp = tf.zeros([3, 1])
+    samples = chunk_samples(U.args, 43)
+
+    outs = U.generate_comparison(inp, gens, dec, dec2, batch_size=64, samples=samples)
+    assert len(outs) == 3
+    for gen, out in zip(gens, outs):
+        ref = U.generate_waveform(inp, gen, dec, dec2, batch_size=64, samples=samples)
+        np.testing.assert_allclose(out, ref, atol=1e-5)
+
+
+@pytest.mark.parametrize("first_chunks", [1, 5, 8, 16])
+@pytest.mark.parametrize("chunks", [None, 40])
+def test_stream_matches_generate_waveform(U, first_chunks, chunks):
+    # the iSTFT context carried between chunks must make the stream seamless
+    gen, dec, dec2 = fake_gen(U.args), fake_dec(U.args), fake_dec2(U.args)
+    inp = tf.range(3, dtype=tf.float32)[:, tf.newaxis]
+    samples = None if chunks is None else chunk_samples(U.args, chunks)
+
+    ref = U.generate_waveform(inp, gen, dec, dec2, batch_size=64, samples=samples)
+    stream = np.concatenate(
+        list(U.generate_waveform_stream(inp, gen, dec, dec2, batch_size=64, first_chunks=first_chunks, samples=samples)),
+        0,
+    )
+    if samples is not None:
+        stream = stream[:samples]
+    assert stream.shape == ref.shape
+    np.testing.assert_allclose(stream, ref, atol=1e-5)
+
+
+def loop_reference(U, gen, dec, dec2):
+    # steady-state iSTFT of three consecutive periods, middle period
+    ab = gen(tf.ones([1, 1]), training=False)
+    abi = tf.concat(tf.split(ab, ab.shape[-2] // 8, -2), 0)
+    chls = []
+    for SP in U.decode_specphase(abi, dec, dec2, batch_size=64):
+        frames = SP.shape[0]
+        wv = U.inverse_stft(tf.concat([SP, SP, SP], 0))
+        chls.append(np.asarray(wv[frames * U.args.hop : 2 * frames * U.args.hop]))
+    return np.clip(np.stack(chls, -1), -1.0, 1.0)
+
+
+def test_generate_loop_seam(U, monkeypatch):
+    monkeypatch.setattr(U, "get_noise_interp_loop", lambda fac, var, seed=None: tf.ones([1, 1]))
+    gen, dec, dec2 = fake_gen(U.args), fake_dec(U.args), fake_dec2(U.args)
+    ref = loop_reference(U, gen, dec, dec2)
+    period = ref.shape[0]
+
+    out = U.generate_loop(3, 1.8, gen, dec, dec2, batch_size=64)
+    assert out.shape == (3 * period, 2)
+    np.testing.assert_allclose(out, np.concatenate([ref] * 3, 0), atol=1e-5)
+
+
+@pytest.mark.parametrize("chunks", [1, 5, 20])
+def test_generate_loop_samples(U, monkeypatch, chunks):
+    monkeypatch.setattr(U, "get_noise_interp_loop", lambda fac, var, seed=None: tf.ones([1, 1]))
+    gen, dec, dec2 = fake_gen(U.args), fake_dec(U.args), fake_dec2(U.args)
+    ref = loop_reference(U, gen, dec, dec2)
+    samples = chunk_samples(U.args, chunks)
+
+    out = U.generate_loop(2, 1.8, gen, dec, dec2, batch_size=64, samples=samples)
+    assert out.shape == (samples, 2)
+    np.testing.assert_allclose(out, np.concatenate([ref] * 2, 0)[:samples], atol=1e-5)
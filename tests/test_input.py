@@ -0,0 +1,10 @@
+import time
+
+
+def test_timed_batches_measures_the_step(U):
+    for _ in U.timed_batches(range(3)):
+        time.sleep(0.05)
+    summary = U.metrics.summary()
+    assert summary["step_compute"]["count"] == 3
+    assert summary["step_compute"]["mean"] >= 0.04
+    assert summary["input_wait"]["mean"] < 0.04
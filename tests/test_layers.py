@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from layers import ConvSN2D, DenseSN
+
+
+@pytest.mark.parametrize(
+    "layer, shape",
+    [
+        (lambda: ConvSN2D(8, 3, padding="same"), [2, 6, 6, 4]),
+        (lambda: DenseSN(units=8), [2, 5]),
+    ],
+)
+def test_freeze_matches_spectral_norm(layer, shape):
+    layer = layer()
+    x = tf.random.stateless_normal(shape, [0, 0])
+    # let the power iteration converge, every forward pass runs one step
+    for _ in range(200):
+        before = layer(x)
+    kernel = layer.kernel.numpy()
+
+    layer.freeze()
+    after = layer(x)
+    np.testing.assert_allclose(after, before, rtol=1e-4, atol=1e-5)
+    # the raw kernel is kept, so unfreezing restores the training behaviour
+    np.testing.assert_array_equal(layer.kernel.numpy(), kernel)
+
+    layer.unfreeze()
+    np.testing.assert_allclose(layer(x), before, rtol=1e-4, atol=1e-5)
@@ -1,21 +1,34 @@
 import os
 import time
 import datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from glob import glob
 from tqdm import tqdm
 import librosa
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import numpy as np
 import tensorflow as tf
 from tensorflow.python.framework import random_seed
 import gradio as gr
 from scipy.io.wavfile import write as write_wav
 
+from metrics import Metrics
+from scheduler import Scheduler, SchedulerFull
+from checkpoint import save_sharded
+from constants import GENRES, MAX_SECONDS
+
 
 class Utils_functions:
     def __init__(self, args):
 
         self.args = args
+        self.metrics = Metrics()
+        self.saver = ThreadPoolExecutor(max_workers=1)
+        self.shadow_models = {}
+        # optional name -> context manager wrapped around each stage of a render (see profile_memory.py)
+        self.stage_hook = None
+        self.scheduler = Scheduler(args.max_concurrent, args.max_queued, args.aging, self.metrics)
 
         melmat = tf.signal.linear_to_mel_weight_matrix(
             num_mel_bins=args.mel_bins,
@@ -39,7 +52,7 @@ class Utils_functions:
         with np.errstate(divide="ignore", invalid="ignore"):
             self.melmatinv = tf.constant(np.nan_to_num(np.divide(melmat.numpy().T, np.sum(melmat.numpy(), axis=1))).T)
 
-    def conc_tog_specphase(self, S, P):
+    def conc_specphase(self, S, P):
         S = tf.cast(S, tf.float32)
         P = tf.cast(P, tf.float32)
         S = self.denormalize(S, clip=False)
@@ -49,14 +62,20 @@ class Utils_functions:
         S = tf.squeeze(tf.concat(Sls, 1), 0)
         Pls = tf.split(P, P.shape[0], 0)
         P = tf.squeeze(tf.concat(Pls, 1), 0)
-        SP = tf.cast(S, tf.complex64) * tf.math.exp(1j * tf.cast(P, tf.complex64))
-        wv = tf.signal.inverse_stft(
+        return tf.cast(S, tf.complex64) * tf.math.exp(1j * tf.cast(P, tf.complex64))
+
+    # output sample block [k*hop, (k+1)*hop) only depends on frames k-3..k
+    def inverse_stft(self, SP):
+        return tf.signal.inverse_stft(
             SP,
             4 * self.args.hop,
             self.args.hop,
             fft_length=4 * self.args.hop,
             window_fn=tf.signal.inverse_stft_window_fn(self.args.hop),
         )
+
+    def conc_tog_specphase(self, S, P):
+        wv = self.inverse_stft(self.conc_specphase(S, P))
         return np.squeeze(wv)
 
     def _tf_log10(self, x):
@@ -145,6 +164,13 @@ class Utils_functions:
         S = self.normalize(self.power2db(tf.abs(X) ** 2, top_db=topdb))
         return tf.tensordot(S, self.melmat, 1)
 
+    def spectral_distance(self, wv_ref, wv):
+        # mean absolute distance between log-mel spectrograms of the mid channels
+        n = min(wv_ref.shape[0], wv.shape[0])
+        S_ref = self.wv2spec_hop(np.mean(wv_ref[:n], -1), 80.0, self.args.hop * 2)
+        S = self.wv2spec_hop(np.mean(wv[:n], -1), 80.0, self.args.hop * 2)
+        return float(tf.reduce_mean(tf.abs(S_ref - S)))
+
     def rand_channel_swap(self, x):
         s_l, s_r = tf.split(x, 2, -1)
         if tf.random.uniform((), dtype=tf.float32) > 0.5:
@@ -159,11 +185,11 @@ class Utils_functions:
         outls = []
         if isinstance(x, list):
             bdim = x[0].shape[0]
-            for i in range(((bdim - 2) // bs) + 1):
+            for i in range(-(-bdim // bs)):
                 outls.append(model([el[i * bs : i * bs + bs] for el in x], training=False))
         else:
             bdim = x.shape[0]
-            for i in range(((bdim - 2) // bs) + 1):
+            for i in range(-(-bdim // bs)):
                 outls.append(model(x[i * bs : i * bs + bs], training=False))
 
         if dual_out:
@@ -177,14 +203,14 @@ class Utils_functions:
         outls = []
         if isinstance(x, list):
             bdim = x[0].shape[0]
-            for i in range(((bdim - 2) // bs) + 1):
+            for i in range(-(-bdim // bs)):
                 res = model([el[i * bs : i * bs + bs] for el in x], training=False)
                 resls = tf.split(res, self.args.shape // self.args.window, 0)
                 res = tf.concat(resls, -2)
                 outls.append(res)
         else:
             bdim = x.shape[0]
-            for i in range(((bdim - 2) // bs) + 1):
+            for i in range(-(-bdim // bs)):
                 res = model(x[i * bs : i * bs + bs], training=False)
                 resls = tf.split(res, self.args.shape // self.args.window, 0)
                 res = tf.concat(resls, -2)
@@ -195,20 +221,21 @@ class Utils_functions:
     def distribute_dec(self, x, model, bs=32):
         outls = []
         bdim = x.shape[0]
-        for i in range(((bdim - 2) // bs) + 1):
+        for i in range(-(-bdim // bs)):
             inp = x[i * bs : i * bs + bs]
             inpls = tf.split(inp, 2, -2)
             inp = tf.concat(inpls, 0)
             res = model(inp, training=False)
             outls.append(res)
-        return np.concatenate([outls[k][0] for k in range(len(outls))], 0), np.concatenate(
+        # stays a tensor: conc_specphase continues in TF, the waveform is only converted at the very end
+        return tf.concat([outls[k][0] for k in range(len(outls))], 0), tf.concat(
             [outls[k][1] for k in range(len(outls))], 0
         )
 
     def distribute_dec2(self, x, model, bs=32):
         outls = []
         bdim = x.shape[0]
-        for i in range(((bdim - 2) // bs) + 1):
+        for i in range(-(-bdim // bs)):
             inp1 = x[i * bs : i * bs + bs]
             inpls = tf.split(inp1, 2, -2)
             inp1 = tf.concat(inpls, 0)
@@ -221,47 +248,77 @@ class Utils_functions:
     ):  # allows to have sequences with even number length with anchor in the middle of the sequence
         return tf.reduce_mean(tf.stack([x, tf.roll(x, -1, -2)], 0), 0)[:, :-1, :]
 
-    # hardcoded! need to figure out how to generalize it without breaking jit compiling
     def crop_coordinate(
         self, x
     ):  # randomly crops a conditioning sequence such that the anchor vector is at center of generator receptive field (maximum context is provided to the generator)
-        fac = tf.random.uniform((), 0, self.args.coordlen // (self.args.latlen // 2), dtype=tf.int32)
-        if fac == 0:
-            return tf.reshape(
-                x[
-                    :,
-                    (self.args.latlen // 4)
-                    + 0 * (self.args.latlen // 2) : (self.args.latlen // 4)
-                    + 0 * (self.args.latlen // 2)
-                    + self.args.latlen,
-                    :,
-                ],
-                [-1, self.args.latlen, x.shape[-1]],
-            )
-        elif fac == 1:
-            return tf.reshape(
-                x[
-                    :,
-                    (self.args.latlen // 4)
-                    + 1 * (self.args.latlen // 2) : (self.args.latlen // 4)
-                    + 1 * (self.args.latlen // 2)
-                    + self.args.latlen,
-                    :,
-                ],
-                [-1, self.args.latlen, x.shape[-1]],
-            )
-        else:
-            return tf.reshape(
-                x[
-                    :,
-                    (self.args.latlen // 4)
-                    + 2 * (self.args.latlen // 2) : (self.args.latlen // 4)
-                    + 2 * (self.args.latlen // 2)
-                    + self.args.latlen,
-                    :,
-                ],
-                [-1, self.args.latlen, x.shape[-1]],
-            )
+        # one offset per batch element, all windows gathered at once so that the graph has no branches
+        fac = tf.random.uniform([tf.shape(x)[0], 1], 0, self.args.coordlen // (self.args.latlen // 2), dtype=tf.int32)
+        idx = (self.args.latlen // 4) + fac * (self.args.latlen // 2) + tf.range(self.args.latlen)[tf.newaxis, :]
+        return tf.gather(x, idx, axis=1, batch_dims=1)
+
+    def read_latent(self, path):
+        lat = tf.numpy_function(lambda p: np.load(p).astype(np.float32), [path], tf.float32)
+        return tf.reshape(lat, [-1, self.args.latdepth * 2])
+
+    def random_crop(self, lat):
+        start = tf.random.uniform((), 0, tf.shape(lat)[0] - self.args.latlen + 1, dtype=tf.int32)
+        return lat[start : start + self.args.latlen]
+
+    def create_dataset(self):
+        pathls = glob(self.args.train_path + "/*.npy")
+        # only the headers are read to count the windows of an epoch
+        lens = [np.load(p, mmap_mode="r").shape[0] for p in pathls]
+        pathls = [p for p, l in zip(pathls, lens) if l >= self.args.latlen]
+        crops = [l // self.args.latlen for l in lens if l >= self.args.latlen]
+        self.args.totsamples = sum(crops)
+        print(f"Found {len(pathls)} files, {self.args.totsamples} windows per epoch")
+
+        ds = tf.data.Dataset.from_tensor_slices((pathls, crops))
+        ds = ds.interleave(
+            lambda p, n: tf.data.Dataset.from_tensors((self.read_latent(p), n)),
+            cycle_length=16,
+            num_parallel_calls=tf.data.AUTOTUNE,
+            deterministic=False,
+        )
+        if self.args.cache_dataset:
+            ds = ds.cache()
+        ds = ds.shuffle(len(pathls))
+        # a new random window (and channel order) for every crop in every epoch
+        ds = ds.flat_map(lambda lat, n: tf.data.Dataset.from_tensors(lat).repeat(n))
+        ds = ds.map(
+            lambda lat: self.rand_channel_swap(self.random_crop(lat)),
+            num_parallel_calls=tf.data.AUTOTUNE,
+        )
+        ds = ds.shuffle(self.args.shuffle_buffer)
+        ds = ds.batch(self.args.bs, drop_remainder=True)
+        return ds.prefetch(tf.data.AUTOTUNE)
+
+    def timed_batches(self, ds):
+        # yields the batches of ds, recording how long each step waited for input and how long it computed
+        it = iter(ds)
+        while True:
+            bef = time.time()
+            try:
+                batch = next(it)
+            except StopIteration:
+                return
+            handed = time.time()
+            self.metrics.record("input_wait", handed - bef)
+            # resumes when the consumer asks for the next batch, i.e. after its step
+            yield batch
+            self.metrics.record("step_compute", time.time() - handed)
+
+    def input_report(self):
+        summary = self.metrics.summary()
+        if "input_wait" not in summary or "step_compute" not in summary:
+            return
+        wait = summary["input_wait"]["mean"]
+        compute = summary["step_compute"]["mean"]
+        bound = "input" if wait > compute else "compute"
+        print(
+            f"Input wait {wait * 1000:.1f} ms - compute {compute * 1000:.1f} ms per step "
+            f"({100 * wait / (wait + compute):.0f}% waiting, {bound}-bound)"
+        )
 
     def update_switch(self, switch, ca, cab, learning_rate_switch=0.0001, stable_point=0.9):
         cert = tf.math.minimum(tf.math.maximum(tf.reduce_mean(ca) - tf.reduce_mean(cab), 0.0), 2.0) / 2.0
@@ -286,7 +343,7 @@ class Utils_functions:
         noisetot = self.center_coordinate(noisetot)
         return self.crop_coordinate(noisetot)
 
-    def generate_example_stereo(self, models_ls):
+    def generate_example_stereo_batch(self, models_ls, n=4):
         (
             critic,
             gen,
@@ -298,116 +355,66 @@ class Utils_functions:
             [opt_dec, opt_disc],
             switch,
         ) = models_ls
-        abb = gen_ema(self.get_noise_interp(), training=False)
+        abb = gen_ema(tf.concat([self.get_noise_interp() for _ in range(n)], 0), training=False)
+        abbls = tf.split(abb, abb.shape[0], 0)
+        abb = tf.concat(abbls, -2)
         abbls = tf.split(abb, abb.shape[-2] // 8, -2)
         abb = tf.concat(abbls, 0)
 
-        chls = []
-        for channel in range(2):
-
-            ab = self.distribute_dec2(
-                abb[
-                    :,
-                    :,
-                    :,
-                    channel * self.args.latdepth : channel * self.args.latdepth + self.args.latdepth,
-                ],
-                dec2,
-            )
-            abls = tf.split(ab, ab.shape[-2] // self.args.shape, -2)
-            ab = tf.concat(abls, 0)
-            ab_m, ab_p = self.distribute_dec(ab, dec)
-            wv = self.conc_tog_specphase(ab_m, ab_p)
-            chls.append(wv)
-
-        return np.stack(chls, -1)
+        # one decoder pass for all samples, one iSTFT per sample so that they do not overlap
+        spls = [tf.split(SP, n, 0) for SP in self.decode_specphase(abb, dec, dec2)]
+        return [np.stack([np.squeeze(self.inverse_stft(spls[ch][i])) for ch in range(2)], -1) for i in range(n)]
 
     # Save in training loop
     def save_test_image_full(self, path, models_ls=None):
 
-        abwv = self.generate_example_stereo(models_ls)
-        abwv2 = self.generate_example_stereo(models_ls)
-        abwv3 = self.generate_example_stereo(models_ls)
-        abwv4 = self.generate_example_stereo(models_ls)
-
-        # IPython.display.display(
-        #     IPython.display.Audio(np.squeeze(np.transpose(abwv)), rate=self.args.sr)
-        # )
-        # IPython.display.display(
-        #     IPython.display.Audio(np.squeeze(np.transpose(abwv2)), rate=self.args.sr)
-        # )
-        # IPython.display.display(
-        #     IPython.display.Audio(np.squeeze(np.transpose(abwv3)), rate=self.args.sr)
-        # )
-        # IPython.display.display(
-        #     IPython.display.Audio(np.squeeze(np.transpose(abwv4)), rate=self.args.sr)
-        # )
-
-        write_wav(f"{path}/out1.wav", self.args.sr, np.squeeze(abwv))
-        write_wav(f"{path}/out2.wav", self.args.sr, np.squeeze(abwv2))
-        write_wav(f"{path}/out3.wav", self.args.sr, np.squeeze(abwv3))
-        write_wav(f"{path}/out4.wav", self.args.sr, np.squeeze(abwv4))
-
-        fig, axs = plt.subplots(nrows=4, ncols=1, figsize=(20, 20))
-        axs[0].imshow(
-            np.flip(
-                np.array(
-                    tf.transpose(
-                        self.wv2spec_hop((abwv[:, 0] + abwv[:, 1]) / 2.0, 80.0, self.args.hop * 2),
-                        [1, 0],
-                    )
-                ),
-                -2,
-            ),
-            cmap=None,
-        )
-        axs[0].axis("off")
-        axs[0].set_title("Generated1")
-        axs[1].imshow(
-            np.flip(
-                np.array(
-                    tf.transpose(
-                        self.wv2spec_hop((abwv2[:, 0] + abwv2[:, 1]) / 2.0, 80.0, self.args.hop * 2),
-                        [1, 0],
-                    )
-                ),
-                -2,
-            ),
-            cmap=None,
-        )
-        axs[1].axis("off")
-        axs[1].set_title("Generated2")
-        axs[2].imshow(
-            np.flip(
-                np.array(
-                    tf.transpose(
-                        self.wv2spec_hop((abwv3[:, 0] + abwv3[:, 1]) / 2.0, 80.0, self.args.hop * 2),
-                        [1, 0],
-                    )
-                ),
-                -2,
-            ),
-            cmap=None,
-        )
-        axs[2].axis("off")
-        axs[2].set_title("Generated3")
-        axs[3].imshow(
-            np.flip(
-                np.array(
-                    tf.transpose(
-                        self.wv2spec_hop((abwv4[:, 0] + abwv4[:, 1]) / 2.0, 80.0, self.args.hop * 2),
-                        [1, 0],
-                    )
+        wvs = self.generate_example_stereo_batch(models_ls, 4)
+
+        # pyplot is not thread-safe, draw on a standalone figure
+        fig = Figure(figsize=(20, 20))
+        axs = fig.subplots(nrows=4, ncols=1)
+        for i, abwv in enumerate(wvs):
+            write_wav(f"{path}/out{i + 1}.wav", self.args.sr, np.squeeze(abwv))
+            axs[i].imshow(
+                np.flip(
+                    np.array(
+                        tf.transpose(
+                            self.wv2spec_hop((abwv[:, 0] + abwv[:, 1]) / 2.0, 80.0, self.args.hop * 2),
+                            [1, 0],
+                        )
+                    ),
+                    -2,
                 ),
-                -2,
-            ),
-            cmap=None,
+                cmap=None,
+            )
+            axs[i].axis("off")
+            axs[i].set_title(f"Generated{i + 1}")
+        fig.savefig(f"{path}/output.png")
+
+    def write_checkpoint(self, path, snapshot, models_ls):
+        if self.args.ckpt_format == "sharded":
+            self.shadow_models["gen_ema"].set_weights(snapshot["gen_ema"])
+            save_sharded(path, {**snapshot, "switch": [snapshot["switch"]]})
+        else:
+            for name in ["critic", "gen", "gen_ema"]:
+                self.shadow_models[name].set_weights(snapshot[name])
+                self.shadow_models[name].save_weights(f"{path}/{name}.h5")
+            np.save(path + "/opt_dec.npy", snapshot["opt_dec"])
+            np.save(path + "/opt_disc.npy", snapshot["opt_disc"])
+            np.save(path + "/switch.npy", snapshot["switch"])
+        critic, gen, enc, dec, enc2, dec2, gen_ema, [opt_dec, opt_disc], switch = models_ls
+        self.save_test_image_full(
+            path,
+            models_ls=(critic, gen, enc, dec, enc2, dec2, self.shadow_models["gen_ema"], [opt_dec, opt_disc], switch),
         )
-        axs[3].axis("off")
-        axs[3].set_title("Generated4")
-        # plt.show()
-        plt.savefig(f"{path}/output.png")
-        plt.close()
+
+    def save_done(self, future):
+        if future.exception() is not None:
+            print(f"Saving failed: {future.exception()!r}")
+
+    # block until every checkpoint handed to the background writer is on disk
+    def wait_saves(self):
+        self.saver.submit(lambda: None).result()
 
     def save_end(
         self,
@@ -420,92 +427,251 @@ class Utils_functions:
         save_path="checkpoints",
     ):
         (critic, gen, enc, dec, enc2, dec2, gen_ema, [opt_dec, opt_disc], switch) = models_ls
+        self.input_report()
         if epoch % n_save == 0:
             print("Saving...")
             path = f"{save_path}/MUSIKA_iterations-{((epoch+1)*self.args.totsamples)//(self.args.bs*1000)}k_losses-{str(gloss)[:9]}-{str(closs)[:9]}-{str(mloss)[:9]}"
             os.mkdir(path)
-            critic.save_weights(path + "/critic.h5")
-            gen.save_weights(path + "/gen.h5")
-            gen_ema.save_weights(path + "/gen_ema.h5")
             # enc.save_weights(path + "/enc.h5")
             # dec.save_weights(path + "/dec.h5")
             # enc2.save_weights(path + "/enc2.h5")
             # dec2.save_weights(path + "/dec2.h5")
-            np.save(path + "/opt_dec.npy", opt_dec.get_weights())
-            np.save(path + "/opt_disc.npy", opt_disc.get_weights())
-            np.save(path + "/switch.npy", switch.numpy())
-            self.save_test_image_full(path, models_ls=models_ls)
-
-    def truncated_normal(self, shape, bound=2.0, dtype=tf.float32):
-        seed1, seed2 = random_seed.get_seed(tf.random.uniform((), tf.int32.min, tf.int32.max, dtype=tf.int32))
-        return tf.random.stateless_parameterized_truncated_normal(shape, [seed1, seed2], 0.0, 1.0, -bound, bound)
+            if not self.shadow_models:
+                self.shadow_models = {
+                    "critic": tf.keras.models.clone_model(critic),
+                    "gen": tf.keras.models.clone_model(gen),
+                    "gen_ema": tf.keras.models.clone_model(gen_ema),
+                }
+            # only copy the weights here, files and previews are written by the background saver
+            snapshot = {
+                "critic": critic.get_weights(),
+                "gen": gen.get_weights(),
+                "gen_ema": gen_ema.get_weights(),
+                "opt_dec": opt_dec.get_weights(),
+                "opt_disc": opt_disc.get_weights(),
+                "switch": switch.numpy(),
+            }
+            self.saver.submit(self.write_checkpoint, path, snapshot, models_ls).add_done_callback(self.save_done)
+
+    def truncated_normal(self, shape, bound=2.0, dtype=tf.float32, rng=None):
+        if rng is None:
+            seed1, seed2 = random_seed.get_seed(tf.random.uniform((), tf.int32.min, tf.int32.max, dtype=tf.int32))
+            seed = [seed1, seed2]
+        else:
+            seed = rng.make_seeds(1)[:, 0]
+        return tf.random.stateless_parameterized_truncated_normal(shape, seed, 0.0, 1.0, -bound, bound)
 
     def distribute_gen(self, x, model, bs=32):
         outls = []
         bdim = x.shape[0]
-        if bdim == 1:
-            bdim = 2
-        for i in range(((bdim - 2) // bs) + 1):
+        for i in range(-(-bdim // bs)):
             outls.append(model(x[i * bs : i * bs + bs], training=False))
         return tf.concat(outls, 0)
 
-    def generate_waveform(self, inp, gen_ema, dec, dec2, batch_size=64):
+    def stage(self, name):
+        return nullcontext() if self.stage_hook is None else self.stage_hook(name)
 
-        ab = self.distribute_gen(inp, gen_ema, bs=batch_size)
+    def generate_waveform(
+        self, inp, gen_ema, dec, dec2, batch_size=64, dtype=np.float32, mono="none", samples=None
+    ):
+
+        with self.stage("gen_ema"):
+            ab = self.distribute_gen(inp, gen_ema, bs=batch_size)
         abls = tf.split(ab, ab.shape[0], 0)
         ab = tf.concat(abls, -2)
         abls = tf.split(ab, ab.shape[-2] // 8, -2)
         abi = tf.concat(abls, 0)
-
-        chls = []
-        for channel in range(2):
-
-            ab = self.distribute_dec2(
-                abi[:, :, :, channel * self.args.latdepth : channel * self.args.latdepth + self.args.latdepth],
-                dec2,
-                bs=batch_size,
-            )
-            abls = tf.split(ab, ab.shape[-2] // self.args.shape, -2)
-            ab = tf.concat(abls, 0)
-
-            ab_m, ab_p = self.distribute_dec(ab, dec, bs=batch_size)
-            abwv = self.conc_tog_specphase(ab_m, ab_p)
-            chls.append(abwv)
-
-        return np.clip(np.squeeze(np.stack(chls, -1)), -1.0, 1.0)
-
-    def decode_waveform(self, lat, dec, dec2, batch_size=64):
+        if samples is not None:
+            abi = abi[: self.needed_chunks(samples)]
+
+        out = self.output_buffer(abi.shape[0] * self.args.shape, dtype, 1 if mono != "none" else 2)
+        for channel, SP in enumerate(self.decode_specphase(abi, dec, dec2, batch_size, mono)):
+            with self.stage("inverse_stft"):
+                wv = self.inverse_stft(SP)
+            with self.stage("assembly"):
+                self.write_channel(out, channel, wv)
+        return out if samples is None else out[:samples]
+
+    def generate_comparison(
+        self, inp, gen_emas, dec, dec2, batch_size=64, dtype=np.float32, mono="none", samples=None
+    ):
+        # the same coordinates through every generator, with all their latents decoded as one batch
+        lats = [self.distribute_gen(inp, gen_ema, bs=batch_size) for gen_ema in gen_emas]
+        return self.decode_batch(lats, dec, dec2, batch_size, dtype, mono, samples)
+
+    def decode_batch(self, lats, dec, dec2, batch_size=64, dtype=np.float32, mono="none", samples=None):
+        # decodes several generated pieces of the same length in one DEC2/DEC batch, one waveform each
+        abils = []
+        for ab in lats:
+            abls = tf.split(ab, ab.shape[0], 0)
+            ab = tf.concat(abls, -2)
+            abls = tf.split(ab, ab.shape[-2] // 8, -2)
+            abi = tf.concat(abls, 0)
+            if samples is not None:
+                abi = abi[: self.needed_chunks(samples)]
+            abils.append(abi)
+        abi = tf.concat(abils, 0)
+
+        n = len(abils)
+        channels = 1 if mono != "none" else 2
+        outs = [self.output_buffer(abils[0].shape[0] * self.args.shape, dtype, channels) for _ in range(n)]
+        for channel, SP in enumerate(self.decode_specphase(abi, dec, dec2, batch_size, mono)):
+            for out, SPv in zip(outs, tf.split(SP, n, 0)):
+                self.write_channel(out, channel, self.inverse_stft(SPv))
+        return [out if samples is None else out[:samples] for out in outs]
+
+    def generate_best_of(
+        self,
+        fac,
+        var,
+        gen_ema,
+        critic,
+        dec,
+        dec2,
+        n=8,
+        k=1,
+        batch_size=64,
+        dtype=np.float32,
+        mono="none",
+        samples=None,
+        seed=None,
+    ):
+        # samples n coordinate sets, scores their generator windows with the critic in one batch
+        # and only decodes the k pieces with the highest mean score
+        inp = tf.concat(
+            [self.get_noise_interp_multi(fac, var, seed=None if seed is None else seed + i) for i in range(n)], 0
+        )
+        ab = self.distribute_gen(inp, gen_ema, bs=batch_size)
+        scores = tf.reduce_mean(tf.reshape(self.distribute_gen(ab, critic, bs=batch_size), [n, fac]), -1)
+        self.metrics.record("best_of_score", float(tf.reduce_max(scores)))
+        best = np.argsort(-scores.numpy())[:k]
+        return self.decode_batch([ab[i * fac : (i + 1) * fac] for i in best], dec, dec2, batch_size, dtype, mono, samples)
+
+    # output block k only needs frames up to k, and every 8-column latent chunk decodes to shape frames
+    def needed_chunks(self, samples):
+        frames = -(-samples // self.args.hop)
+        return -(-frames // self.args.shape)
+
+    def duration_plan(self, seconds):
+        # generator windows and exact number of samples for a duration in seconds
+        samples = max(int(round(seconds * self.args.sr)), 1)
+        fac = -(-self.needed_chunks(samples) // (self.args.latlen // 8))
+        return fac, samples
+
+    # scheduler cost of a duration, in generator windows
+    def duration_windows(self, seconds):
+        return self.duration_plan(seconds)[1] / ((self.args.latlen // 8) * self.args.shape * self.args.hop)
+
+    # interleaved buffer for the iSTFT of frames spectrogram frames
+    def output_buffer(self, frames, dtype=np.float32, channels=2):
+        return np.empty(((frames + 3) * self.args.hop, channels), dtype=dtype)
+
+    def write_channel(self, out, channel, wv, start=0, block=2**16):
+        # clips (and scales for int16 buffers) one channel straight into out, through a small float block
+        wv = np.asarray(wv)
+        dst = out[start : start + wv.shape[0], channel]
+        if out.dtype != np.int16:
+            np.clip(wv, -1.0, 1.0, out=dst)
+            return
+        tmp = np.empty(min(block, wv.shape[0]), dtype=np.float32)
+        for i in range(0, wv.shape[0], block):
+            n = min(block, wv.shape[0] - i)
+            np.clip(wv[i : i + n], -1.0, 1.0, out=tmp[:n])
+            tmp[:n] *= 32767.0
+            dst[i : i + n] = tmp[:n]
+
+    def channel_latents(self, abi, mono="none"):
+        # latent halves of the stereo channels, or a single mono representation: their average (mid) or the left half
+        d = self.args.latdepth
+        if mono == "mid":
+            return [(abi[:, :, :, :d] + abi[:, :, :, d:]) / 2.0]
+        elif mono == "left":
+            return [abi[:, :, :, :d]]
+        return [abi[:, :, :, :d], abi[:, :, :, d:]]
+
+    def decode_specphase(self, abi, dec, dec2, batch_size=64, mono="none"):
+        # complex spectrogram frames of each output channel for a batch of 8-wide latent chunks
+        spls = []
+        for lat in self.channel_latents(abi, mono):
+
+            with self.stage("DEC2"):
+                ab = self.distribute_dec2(lat, dec2, bs=batch_size)
+                abls = tf.split(ab, ab.shape[-2] // self.args.shape, -2)
+                ab = tf.concat(abls, 0)
+
+            with self.stage("DEC"):
+                ab_m, ab_p = self.distribute_dec(ab, dec, bs=batch_size)
+            with self.stage("conc_specphase"):
+                spls.append(self.conc_specphase(ab_m, ab_p))
+
+        return spls
+
+    def generate_waveform_stream(
+        self, inp, gen_ema, dec, dec2, batch_size=64, first_chunks=8, mono="none", samples=None
+    ):
+        # yields consecutive stereo chunks, starting with first_chunks latent chunks and doubling up to
+        # one window per chunk; concatenated they match generate_waveform
+        hop = self.args.hop
+        ctx = [None, None]
+        group = first_chunks
+        pending = None
+        nwin = inp.shape[0]
+        for i in range(nwin):
+            ab = gen_ema(inp[i : i + 1], training=False)
+            abls = tf.split(ab, ab.shape[-2] // 8, -2)
+            abi = tf.concat(abls, 0)
+            if samples is not None and i == nwin - 1:
+                abi = abi[: self.needed_chunks(samples) - i * abi.shape[0]]
+            pending = abi if pending is None else tf.concat([pending, abi], 0)
+
+            while pending.shape[0] >= group or (i == nwin - 1 and pending.shape[0] > 0):
+                cur, pending = pending[:group], pending[group:]
+                last = i == nwin - 1 and pending.shape[0] == 0
+
+                chls = []
+                for channel, SP in enumerate(self.decode_specphase(cur, dec, dec2, batch_size=batch_size, mono=mono)):
+                    skip = 0
+                    if ctx[channel] is not None:
+                        skip = 3 * hop
+                        SP_in = tf.concat([ctx[channel], SP], 0)
+                    else:
+                        SP_in = SP
+                    wv = self.inverse_stft(SP_in)
+                    if not last:
+                        # trailing blocks still need the next frames
+                        wv = wv[: wv.shape[0] - 3 * hop]
+                    chls.append(wv[skip:])
+                    ctx[channel] = SP[-3:]
+
+                yield np.clip(np.stack(chls, -1), -1.0, 1.0)
+                group = min(group * 2, abi.shape[0])
+
+    def decode_waveform(self, lat, dec, dec2, batch_size=64, dtype=np.float32):
 
         lat = lat[:, :, : (lat.shape[-2] // 8) * 8, :]
         abls = tf.split(lat, lat.shape[-2] // 8, -2)
         abi = tf.concat(abls, 0)
 
-        chls = []
-        for channel in range(2):
+        out = self.output_buffer(abi.shape[0] * self.args.shape, dtype)
+        for channel, SP in enumerate(self.decode_specphase(abi, dec, dec2, batch_size)):
+            self.write_channel(out, channel, self.inverse_stft(SP))
+        return out
 
-            ab = self.distribute_dec2(
-                abi[:, :, :, channel * self.args.latdepth : channel * self.args.latdepth + self.args.latdepth],
-                dec2,
-                bs=batch_size,
-            )
-            abls = tf.split(ab, ab.shape[-2] // self.args.shape, -2)
-            ab = tf.concat(abls, 0)
+    def get_noise_anchor(self, noiseg, var=2.0, rng=None):
+        return tf.concat([self.truncated_normal([1, 64], var, dtype=tf.float32, rng=rng), noiseg], -1)
 
-            ab_m, ab_p = self.distribute_dec(ab, dec, bs=batch_size)
-            abwv = self.conc_tog_specphase(ab_m, ab_p)
-            chls.append(abwv)
+    # anchor k sits at coordinate column k * coordlen and only shapes the columns up to its two neighbours
+    def get_noise_anchors(self, fac=1, var=2.0, seed=None):
+        # a local generator keeps seeded requests reproducible when several run concurrently
+        rng = tf.random.Generator.from_seed(seed) if seed is not None else None
 
-        return np.clip(np.squeeze(np.stack(chls, -1)), -1.0, 1.0)
-
-    def get_noise_interp_multi(self, fac=1, var=2.0):
-        noiseg = self.truncated_normal([1, self.args.coorddepth], var, dtype=tf.float32)
+        noiseg = self.truncated_normal([1, self.args.coorddepth], var, dtype=tf.float32, rng=rng)
 
         coordratio = self.args.coordlen // self.args.latlen
 
-        noisels = [
-            tf.concat([self.truncated_normal([1, 64], var, dtype=tf.float32), noiseg], -1)
-            for i in range(3 + ((fac - 1) // coordratio))
-        ]
+        return [self.get_noise_anchor(noiseg, var, rng) for i in range(3 + ((fac - 1) // coordratio))]
+
+    def interp_anchors(self, noisels, fac=1):
         rls = tf.concat(
             [
                 tf.linspace(noisels[k], noisels[k + 1], self.args.coordlen + 1, axis=-2)[:, :-1, :]
@@ -522,12 +688,17 @@ class Utils_functions:
 
         return tf.concat(rls[:fac], 0)
 
-    def get_noise_interp_loop(self, fac=1, var=2.0):
-        noiseg = self.truncated_normal([1, self.args.coorddepth], var, dtype=tf.float32)
+    def get_noise_interp_multi(self, fac=1, var=2.0, seed=None):
+        return self.interp_anchors(self.get_noise_anchors(fac, var, seed), fac)
+
+    def get_noise_interp_loop(self, fac=1, var=2.0, seed=None):
+        rng = tf.random.Generator.from_seed(seed) if seed is not None else None
+
+        noiseg = self.truncated_normal([1, self.args.coorddepth], var, dtype=tf.float32, rng=rng)
 
         coordratio = self.args.coordlen // self.args.latlen
 
-        noisels_pre = [tf.concat([self.truncated_normal([1, 64], var, dtype=tf.float32), noiseg], -1) for i in range(2)]
+        noisels_pre = [self.get_noise_anchor(noiseg, var, rng) for i in range(2)]
         noisels = []
         for k in range(fac + 2):
             noisels.append(noisels_pre[0])
@@ -548,19 +719,46 @@ class Utils_functions:
 
         return tf.concat(rls[:fac], 0)
 
+    # the loop path has a period of exactly one window, so every window has the same coordinates:
+    # render one period and tile it
+    def generate_loop(
+        self, fac, var, gen_ema, dec, dec2, batch_size=64, seed=None, dtype=np.float32, mono="none", samples=None
+    ):
+        ab = gen_ema(self.get_noise_interp_loop(1, var, seed=seed), training=False)
+        abls = tf.split(ab, ab.shape[-2] // 8, -2)
+        abi = tf.concat(abls, 0)
+
+        period = abi.shape[0] * self.args.shape * self.args.hop
+        total = fac * period if samples is None else samples
+        # loops shorter than a period only decode the chunks they need, plus the last one for the seam
+        n = abi.shape[0] if samples is None else min(self.needed_chunks(samples), abi.shape[0])
+        if n < abi.shape[0]:
+            abi = tf.concat([abi[:n], abi[-1:]], 0)
+
+        first = n * self.args.shape * self.args.hop
+        out = np.empty((max(total, first), 1 if mono != "none" else 2), dtype=dtype)
+        for channel, SP in enumerate(self.decode_specphase(abi, dec, dec2, batch_size, mono)):
+            # prepend the last frames so the first blocks get their overlap from the end of the period
+            ctx, SP = SP[-3:], SP[: n * self.args.shape]
+            wv = self.inverse_stft(tf.concat([ctx, SP], 0))
+            self.write_channel(out, channel, wv[3 * self.args.hop : (SP.shape[0] + 3) * self.args.hop])
+
+        for start in range(period, total, period):
+            end = min(start + period, total)
+            out[start:end] = out[: end - start]
+        return out[:total]
+
     def generate(self, models_ls):
         critic, gen, enc, dec, enc2, dec2, gen_ema, [opt_dec, opt_disc], switch = models_ls
         os.makedirs(self.args.save_path, exist_ok=True)
-        fac = (self.args.seconds // 23) + 1
+        fac, samples = self.duration_plan(self.args.seconds)
         print(f"Generating {self.args.num_samples} samples...")
         for i in tqdm(range(self.args.num_samples)):
             wv = self.generate_waveform(
-                self.get_noise_interp_multi(fac, self.args.truncation), gen_ema, dec, dec2, batch_size=64
+                self.get_noise_interp_multi(fac, self.args.truncation), gen_ema, dec, dec2, batch_size=64, samples=samples
             )
             dt = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-            write_wav(
-                f"{self.args.save_path}/{i}_{dt}.wav", self.args.sr, np.squeeze(wv)[: self.args.seconds * self.args.sr]
-            )
+            write_wav(f"{self.args.save_path}/{i}_{dt}.wav", self.args.sr, np.squeeze(wv))
 
     def decode_path(self, models_ls):
         critic, gen, enc, dec, enc2, dec2, gen_ema, [opt_dec, opt_disc], switch = models_ls
@@ -577,82 +775,157 @@ class Utils_functions:
             # dt = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
             write_wav(f"{self.args.save_path}/{bname}.wav", self.args.sr, np.squeeze(wv))
 
-    def stfunc(self, genre, z, var, models_ls_1, models_ls_2, models_ls_3):
+    def select_generation(self, genre, z, models_ls_1, models_ls_2, models_ls_3):
 
-        critic, gen, enc, dec, enc2, dec2, gen_ema_1, [opt_dec, opt_disc], switch = models_ls_1
-        critic, gen, enc, dec, enc2, dec2, gen_ema_2, [opt_dec, opt_disc], switch = models_ls_2
-        critic, gen, enc, dec, enc2, dec2, gen_ema_3, [opt_dec, opt_disc], switch = models_ls_3
+        critic_1, gen, enc, dec, enc2, dec2, gen_ema_1, [opt_dec, opt_disc], switch = models_ls_1
+        critic_2, gen, enc, dec, enc2, dec2, gen_ema_2, [opt_dec, opt_disc], switch = models_ls_2
+        critic_3, gen, enc, dec, enc2, dec2, gen_ema_3, [opt_dec, opt_disc], switch = models_ls_3
 
         if genre == 0:
-            gen_ema = gen_ema_1
+            gen_ema, critic = gen_ema_1, critic_1
         elif genre == 1:
-            gen_ema = gen_ema_2
+            gen_ema, critic = gen_ema_2, critic_2
         else:
-            gen_ema = gen_ema_3
+            gen_ema, critic = gen_ema_3, critic_3
 
         var = float(var)
+        fac, samples = self.duration_plan(float(z))
 
-        if z == 0:
-            fac = 1
-        elif z == 1:
-            fac = 5
-        else:
-            fac = 10
-
-        bef = time.time()
-
-        noiseinp = self.get_noise_interp_multi(fac, var)
-
-        abwvc = self.generate_waveform(noiseinp, gen_ema, dec, dec2, batch_size=64)
-
-        # print(
-        #     f"Time for complete generation pipeline: {time.time()-bef} s        {int(np.round((fac*23.)/(time.time()-bef)))}x faster than Real Time!"
-        # )
+        return gen_ema, critic, dec, dec2, fac, samples, var
 
+    def preview_spec(self, abwvc):
+        mid = np.mean(abwvc[: 23 * self.args.sr], -1, dtype=np.float32)
+        if abwvc.dtype == np.int16:
+            mid /= 32767.0
         spec = np.flip(
             np.array(
                 tf.transpose(
-                    self.wv2spec_hop(
-                        (abwvc[: 23 * self.args.sr, 0] + abwvc[: 23 * self.args.sr, 1]) / 2.0, 80.0, self.args.hop * 2
-                    ),
+                    self.wv2spec_hop(mid, 80.0, self.args.hop * 2),
                     [1, 0],
                 )
             ),
             -2,
         )
+        return np.clip(spec, -1.0, 1.0)
+
+    def stfunc(self, genre, z, var, models_ls_1, models_ls_2, models_ls_3):
+
+        gen_ema, critic, dec, dec2, fac, samples, var = self.select_generation(
+            genre, z, models_ls_1, models_ls_2, models_ls_3
+        )
+
+        bef = time.time()
+
+        if self.args.best_of > 1:
+            abwvc = self.generate_best_of(
+                fac,
+                var,
+                gen_ema,
+                critic,
+                dec,
+                dec2,
+                n=self.args.best_of,
+                batch_size=64,
+                dtype=np.int16,
+                mono=self.args.mono,
+                samples=samples,
+            )[0]
+        else:
+            noiseinp = self.get_noise_interp_multi(fac, var)
+
+            abwvc = self.generate_waveform(
+                noiseinp, gen_ema, dec, dec2, batch_size=64, dtype=np.int16, mono=self.args.mono, samples=samples
+            )
+
+        # print(
+        #     f"Time for complete generation pipeline: {time.time()-bef} s        {int(np.round((fac*23.)/(time.time()-bef)))}x faster than Real Time!"
+        # )
 
         return (
-            np.clip(spec, -1.0, 1.0),
-            (self.args.sr, np.int16(abwvc * 32767.0)),
+            self.preview_spec(abwvc),
+            (self.args.sr, abwvc),
         )
 
-    def render_gradio(self, models_ls_1, models_ls_2, models_ls_3, train=True):
+    def stfunc_stream(self, genre, z, var, models_ls_1, models_ls_2, models_ls_3):
+
+        gen_ema, critic, dec, dec2, fac, samples, var = self.select_generation(
+            genre, z, models_ls_1, models_ls_2, models_ls_3
+        )
+
+        bef = time.time()
+
+        noiseinp = self.get_noise_interp_multi(fac, var)
+
+        out = self.output_buffer(
+            self.needed_chunks(samples) * self.args.shape, np.int16, 1 if self.args.mono != "none" else 2
+        )
+        pos = 0
+        spec = None
+        spec_pos = 0
+        for chunk in self.generate_waveform_stream(
+            noiseinp,
+            gen_ema,
+            dec,
+            dec2,
+            batch_size=64,
+            first_chunks=self.args.stream_chunks,
+            mono=self.args.mono,
+            samples=samples,
+        ):
+            for channel in range(chunk.shape[-1]):
+                self.write_channel(out, channel, chunk[: out.shape[0] - pos, channel], start=pos)
+            pos = min(pos + chunk.shape[0], samples)
+            if spec is None:
+                ttfa = time.time() - bef
+                self.metrics.record("time_to_first_audio", ttfa)
+                print(f"Time to first audio: {ttfa:.3f} s")
+            # the preview covers the first 23 s, so it is redrawn until they are all available
+            if spec_pos < min(23 * self.args.sr, pos):
+                spec = self.preview_spec(out[:pos])
+                spec_pos = pos
+            yield spec, (self.args.sr, out[:pos])
+
+        self.metrics.record("generation_time", time.time() - bef)
+
+    # models_ls is read on every request, so entries swapped by a CheckpointWatcher are picked up
+    def render_gradio(self, models_ls, train=True):
         article_text = "Original work by Marco Pasini ([Twitter](https://twitter.com/marco_ppasini)) at the Institute of Computational Perception, JKU Linz. Supervised by Jan Schlüter."
 
-        def gradio_func(genre, x, y):
-            return self.stfunc(genre, x, y, models_ls_1, models_ls_2, models_ls_3)
+        def check_duration(x):
+            if x is None or not 0.0 < x <= MAX_SECONDS:
+                raise gr.Error(f"The length must be between 0 and {MAX_SECONDS} seconds.")
 
-        if self.args.small:
-            durations = ["11s", "59s", "1m 58s"]
-            durations_default = "59s"
-        else:
-            durations = ["23s", "1m 58s", "3m 57s"]
-            durations_default = "1m 58s"
+        def gradio_func(genre, x, y):
+            check_duration(x)
+            try:
+                with self.scheduler.slot(genre, self.duration_windows(x)):
+                    return self.stfunc(genre, x, y, *models_ls)
+            except SchedulerFull as e:
+                raise gr.Error(str(e))
+
+        # generator outputs need the queue, which is only enabled outside training
+        def gradio_func_stream(genre, x, y):
+            check_duration(x)
+            try:
+                with self.scheduler.slot(genre, self.duration_windows(x)):
+                    yield from self.stfunc_stream(genre, x, y, *models_ls)
+            except SchedulerFull as e:
+                raise gr.Error(str(e))
+
+        durations_default = 59 if self.args.small else 118
 
         iface = gr.Interface(
-            fn=gradio_func,
+            fn=gradio_func_stream if self.args.stream and not train else gradio_func,
             inputs=[
                 gr.Radio(
-                    choices=["ComMU pretrained", "Only Mozart", "Mozart finetuned"],
+                    choices=GENRES,
                     type="index",
                     value="Techno/Experimental",
                     label="Music Genre to Generate",
                 ),
-                gr.Radio(
-                    choices=durations,
-                    type="index",
+                gr.Number(
                     value=durations_default,
-                    label="Generated Music Length",
+                    label="Generated Music Length (seconds)",
                 ),
                 gr.Slider(
                     minimum=0.1,
@@ -671,6 +944,16 @@ class Utils_functions:
             article=article_text,
         )
 
+        # serving measurements (queue wait, generation time, time to first audio) of this process,
+        # read outside the queue so they do not wait behind generations
+        with gr.Blocks(title="Musika! for Mozart") as app:
+            with gr.Tabs():
+                with gr.TabItem("Generate"):
+                    iface.render()
+                with gr.TabItem("Metrics"):
+                    metrics_out = gr.JSON(label="Serving metrics")
+                    gr.Button("Refresh").click(self.metrics.summary, inputs=None, outputs=metrics_out, queue=False)
+
         print("--------------------------------")
         print("--------------------------------")
         print("--------------------------------")
@@ -678,9 +961,15 @@ class Utils_functions:
         print("--------------------------------")
         print("CLICK ON LINK BELOW TO OPEN GRADIO INTERFACE")
         if train:
-            iface.launch(prevent_thread_lock=True)
+            app.launch(prevent_thread_lock=True)
         else:
-            iface.launch(share=True, enable_queue=True)
+            # every admissible request reaches the scheduler, which decides the order; the extra worker lets
+            # overflow reach it too and be rejected with SchedulerFull instead of waiting FIFO in Gradio
+            app.queue(
+                concurrency_count=self.args.max_concurrent + self.args.max_queued + 1,
+                max_size=self.args.max_queued,
+            )
+            app.launch(share=True)
         # iface.launch(share=True, enable_queue=True)
         print("--------------------------------")
         print("--------------------------------")